@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+"""
+Offline benchmark of the chef: scrapes a channel with the fake youtube_dl
+backend on the real resources_*.json layouts, in a temporary directory, and
+reports the throughput, the extraction counts and the peak memory.
+
+    ./benchmark.py --channel=k12 --workers=4 --latency=0.05 --failure-rate=0.05
+
+With --tree-videos it instead builds a synthetic channel tree of that many
+videos, as the node stage does, writes it, rebuilds it from the journal as a
+resumed run does, and reports the peak memory of both.
+
+    ./benchmark.py --tree-videos=50000
+
+With --index-videos it builds a synthetic json tree of that many videos and
+compares the lookups by source_id and by path of utils.TreeIndex with walking
+the tree for each lookup.
+
+    ./benchmark.py --index-videos=50000 --lookups=1000
+
+With --hash-files it writes that many files of --hash-mb MB and compares
+hashing them one by one with the hash index of the chef, on a first run and
+on a re-run where no file changed.
+
+    ./benchmark.py --hash-files=20 --hash-mb=50
+
+With --download-mb it serves a file of that size from a local http server
+with byte ranges, at most --serve-mbps MB/s per connection, and compares
+utils.RangeDownloader with the streamed download flushed every 32 KB that
+utils.save_response_content was; then it interrupts a download halfway and
+resumes it.
+
+    ./benchmark.py --download-mb=200 --segments=4 --serve-mbps=20
+
+With --titles it parses the video titles of the playlist listings saved by a
+run of the chef (chefdata/<channel>/, or --listings) that many times with
+sushichef.parse_title and with the chain of functions it replaced, and checks
+that they agree apart from the "3 1" pairs and the Arabic-Indic digits.
+
+    ./benchmark.py --titles=2000
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests"))
+
+from helpers import FakeBackend, changed_title, old_parse_title, range_server, saved_titles
+
+
+def count_videos(node):
+    if node.get("kind") == "video":
+        return 1
+    return sum(count_videos(child) for child in node.get("children", []))
+
+
+def run(args):
+    options = {
+        "--basic-lessons": "1" if args.channel == "k12" else "0",
+        "--intermedian-lessons": "1" if args.channel == "professional" else "0",
+        "--all-channels": "1" if args.channel == "all" else "0",
+        "--workers": str(args.workers),
+        "--throttle-pause": "0",
+    }
+    #the chef writes in chefdata/ of the working directory
+    import sushichef
+    sushichef.BACKEND = FakeBackend(videos=args.videos, latency=args.latency,
+                                    failure_rate=args.failure_rate, seed=args.seed)
+    chef = sushichef.KingKhaledChef()
+    tracemalloc.start()
+    start = time.time()
+    channels = chef.scrape([], options)
+    for channel in channels:
+        chef.write_tree_to_json(channel)
+    seconds = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    videos = sum(count_videos(channel.channel_tree) for channel in channels)
+    return dict(
+        channel=args.channel,
+        workers=args.workers,
+        seconds=seconds,
+        videos=videos,
+        videos_per_second=videos / seconds if seconds else 0,
+        extractions=sushichef.BACKEND.stats(),
+        collapsed=sushichef.VIDEOS.stats(),
+        peak_traced_memory_mb=peak / 2**20,
+        max_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+    )
+
+
+def tree_memory(args):
+    import sushichef
+    from sushichef import ChannelConfig, Journal, JsonNode, Subject, Topic, Unit, YouTubeResource
+    sushichef.LOGGER.setLevel("WARNING")
+    backend = FakeBackend()
+    chef = sushichef.KingKhaledChef()
+    per_unit, per_topic, per_subject = 5, 20, 10
+
+    def build(journal):
+        channel = ChannelConfig("benchmark", "Benchmark", "", "ricecooker_json_tree_benchmark.json")
+        for s in range(0, args.tree_videos, per_unit * per_topic * per_subject):
+            subject = Subject("Subject {}".format(s), "subject-{}".format(s), channel=channel)
+            for t in range(s, min(args.tree_videos, s + per_unit * per_topic * per_subject),
+                    per_unit * per_topic):
+                topic = Topic("Topic {}".format(t), "topic-{}".format(t))
+                for u in range(t, min(args.tree_videos, t + per_unit * per_topic), per_unit):
+                    unit = Unit("Unit {}".format(u), "unit-{}".format(u))
+                    key = Journal.key(subject, topic, u, unit)
+                    if key not in journal.nodes:
+                        for v in range(u, min(args.tree_videos, u + per_unit)):
+                            youtube = YouTubeResource(YouTubeResource.video_url("{:011d}".format(v)))
+                            youtube.info = backend.video_info(youtube.source_id, {})
+                            youtube.filepath = "videos/{}.mp4".format(youtube.info["id"])
+                            youtube.filename = youtube.info["title"]
+                            unit.resources.append(youtube)
+                            unit.downloads.append(None)
+                        unit.collect()
+                        journal.append(key, unit.to_node())
+                    topic.units.append(unit)
+                    topic.add_node(JsonNode(journal.nodes[key]))
+                subject.topics.append(topic)
+                subject.add_node(topic)
+            channel.subjects.append(subject)
+            channel.channel_tree["children"].append(subject.to_node())
+        chef.write_tree_to_json(channel)
+        return channel
+
+    results = {}
+    journal_path = os.path.join(chef.TREES_DATA_DIR, "benchmark.journal")
+    for name, resume in (("build", False), ("resume", True)):
+        tracemalloc.start()
+        start = time.time()
+        journal = Journal(journal_path, resume=resume)
+        channel = build(journal)
+        journal.close()
+        seconds = time.time() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = dict(
+            seconds=seconds,
+            videos=count_videos(channel.channel_tree),
+            retained_memory_mb=current / 2**20,
+            peak_traced_memory_mb=peak / 2**20)
+        del journal, channel
+    results["tree_size_mb"] = os.path.getsize(
+        os.path.join(chef.TREES_DATA_DIR, "ricecooker_json_tree_benchmark.json")) / 2**20
+    return results
+
+
+def synthetic_tree(videos, per_unit=5, per_topic=20, per_subject=10):
+    def topic_node(source_id, children):
+        return dict(kind="topic", source_id=source_id, title=source_id, children=children)
+
+    subjects = []
+    for s in range(0, videos, per_unit * per_topic * per_subject):
+        topics = []
+        for t in range(s, min(videos, s + per_unit * per_topic * per_subject), per_unit * per_topic):
+            units = []
+            for u in range(t, min(videos, t + per_unit * per_topic), per_unit):
+                units.append(topic_node("unit-{}".format(u), [
+                    dict(kind="video", source_id="video-{}".format(v), title="Video {}".format(v))
+                    for v in range(u, min(videos, u + per_unit))]))
+            topics.append(topic_node("topic-{}".format(t), units))
+        subjects.append(topic_node("subject-{}".format(s), topics))
+    return dict(source_id="channel", title="channel", children=subjects)
+
+
+def scan(tree, source_id):
+    """Level by level walk of the tree, the lookup TreeIndex replaces."""
+    parent = tree["children"]
+    while len(parent) > 0:
+        for child in parent:
+            if child["source_id"] == source_id:
+                return child
+        parent = [node for child in parent for node in child.get("children", [])]
+
+
+def scan_path(tree, levels):
+    for source_id in levels:
+        tree = next(child for child in tree["children"] if child["source_id"] == source_id)
+    return tree
+
+
+def index_lookups(args):
+    from utils import TreeIndex
+    tree = synthetic_tree(args.index_videos)
+    rnd = random.Random(args.seed)
+    indexes = [rnd.randrange(args.index_videos) for _ in range(args.lookups)]
+    per = (5, 5 * 20, 5 * 20 * 10)
+    source_ids = ["video-{}".format(v) for v in indexes]
+    paths = [("subject-{}".format(v // per[2] * per[2]), "topic-{}".format(v // per[1] * per[1]),
+            "unit-{}".format(v // per[0] * per[0]), "video-{}".format(v)) for v in indexes]
+
+    def timed(func, items):
+        start = time.time()
+        for item in items:
+            assert func(item) is not None
+        return time.time() - start
+
+    start = time.time()
+    index = TreeIndex(tree)
+    build = time.time() - start
+    return dict(
+        videos=args.index_videos,
+        lookups=args.lookups,
+        index_build_seconds=build,
+        scan_seconds=timed(lambda source_id: scan(tree, source_id), source_ids),
+        index_seconds=timed(index.get, source_ids),
+        scan_path_seconds=timed(lambda path: scan_path(tree, path), paths),
+        index_path_seconds=timed(index.get_path, paths),
+    )
+
+
+def get_file_hash(filepath, algorithm="sha1", chunk_size=1048576):
+    """A file read and hashed in chunks, as the chef did before the hash index."""
+    file_hash = hashlib.new(algorithm)
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def hashing(args):
+    import sushichef
+    sushichef.LOGGER.setLevel("WARNING")
+    os.makedirs("videos")
+    filepaths = []
+    for i in range(args.hash_files):
+        filepath = os.path.join("videos", "{}.mp4".format(i))
+        with open(filepath, "wb") as f:
+            for _ in range(args.hash_mb):
+                f.write(os.urandom(2**20))
+        filepaths.append(filepath)
+
+    def timed(func):
+        start = time.time()
+        func()
+        return time.time() - start
+
+    serial = timed(lambda: [get_file_hash(filepath) for filepath in filepaths])
+    hashes = sushichef.HashIndex()
+    hashes.open(".", workers=args.workers)
+    first_run = timed(lambda: hashes.update(filepaths))
+    rerun = sushichef.HashIndex()
+    rerun.open(".", workers=args.workers)
+    unchanged = timed(lambda: rerun.update(filepaths))
+    return dict(
+        files=args.hash_files,
+        megabytes=args.hash_files * args.hash_mb,
+        workers=args.workers,
+        serial_seconds=serial,
+        index_first_run_seconds=first_run,
+        index_unchanged_seconds=unchanged,
+        index_files_read_on_rerun=rerun.stats()["cache_misses"],
+    )
+
+
+def flush_per_chunk(url, destination):
+    """The streamed download of utils.save_response_content before the RangeDownloader."""
+    import requests
+    response = requests.get(url, stream=True)
+    with open(destination, "wb") as f:
+        for chunk in response.iter_content(32768):
+            if chunk:
+                f.write(chunk)
+                f.flush()
+
+
+def downloads(args):
+    from utils import RangeDownloader
+    os.makedirs("served")
+    md5 = hashlib.md5()
+    with open(os.path.join("served", "video.mp4"), "wb") as f:
+        for _ in range(args.download_mb):
+            chunk = os.urandom(2**20)
+            md5.update(chunk)
+            f.write(chunk)
+    checksum = md5.hexdigest()
+    server = range_server("served", rate=args.serve_mbps * 2**20 or None)
+    url = "http://127.0.0.1:{}/video.mp4".format(server.server_port)
+
+    def timed(func):
+        start = time.time()
+        func()
+        return time.time() - start
+
+    def verified(destination):
+        with open(destination, "rb") as f:
+            assert hashlib.md5(f.read()).hexdigest() == checksum
+        os.remove(destination)
+
+    results = dict(megabytes=args.download_mb, segments=args.segments,
+                    serve_mbps_per_connection=args.serve_mbps)
+    results["flush_per_chunk_seconds"] = timed(lambda: flush_per_chunk(url, "flushed.mp4"))
+    verified("flushed.mp4")
+    results["range_1_segment_seconds"] = timed(lambda: RangeDownloader(segments=1).download(
+        url, "single.mp4", checksum=checksum))
+    verified("single.mp4")
+    results["range_{}_segments_seconds".format(args.segments)] = timed(
+        lambda: RangeDownloader(segments=args.segments).download(url, "segmented.mp4",
+                                                                    checksum=checksum))
+    verified("segmented.mp4")
+
+    #cut halfway, then resumed
+    server.budget = args.download_mb * 2**19
+    try:
+        RangeDownloader(segments=args.segments, retries=0, checkpoint=2**20).download(
+            url, "resumed.mp4", checksum=checksum)
+    except Exception:
+        pass
+    server.budget = None
+    with open("resumed.mp4.part.json") as f:
+        results["resume_megabytes_kept"] = sum(offset - start
+            for start, _, offset in json.load(f)["segments"]) / 2**20
+    sent = server.sent
+    results["resume_seconds"] = timed(lambda: RangeDownloader(segments=args.segments).download(
+        url, "resumed.mp4", checksum=checksum))
+    results["resume_megabytes_fetched"] = (server.sent - sent) / 2**20
+    verified("resumed.mp4")
+    server.shutdown()
+    return results
+
+
+def titles(args, parsed):
+    from sushichef import parse_title
+    for title in parsed:
+        if not changed_title(title):
+            assert tuple(parse_title(title)) == old_parse_title(title), title
+
+    def timed(func):
+        start = time.time()
+        for _ in range(args.titles):
+            for title in parsed:
+                try:
+                    func(title)
+                except NameError:
+                    pass
+        return time.time() - start
+
+    old = timed(old_parse_title)
+    new = timed(parse_title)
+    return dict(
+        titles=len(parsed) * args.titles,
+        old_chain_seconds=old,
+        parse_title_seconds=new,
+        speedup=old / new if new else None,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--channel", choices=["k12", "professional", "all"], default="k12")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--videos", type=int, default=10, help="videos per playlist")
+    parser.add_argument("--latency", type=float, default=0.)
+    parser.add_argument("--failure-rate", type=float, default=0.)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tree-videos", type=int, default=None,
+                        help="measure the memory of a synthetic tree of that many videos")
+    parser.add_argument("--index-videos", type=int, default=None,
+                        help="measure the tree lookups on a synthetic tree of that many videos")
+    parser.add_argument("--lookups", type=int, default=1000)
+    parser.add_argument("--hash-files", type=int, default=None,
+                        help="measure the hashing of that many local files")
+    parser.add_argument("--hash-mb", type=int, default=10, help="size of each file")
+    parser.add_argument("--download-mb", type=int, default=None,
+                        help="measure the download of a file of that size from a local server")
+    parser.add_argument("--segments", type=int, default=4)
+    parser.add_argument("--serve-mbps", type=float, default=0.,
+                        help="rate of each connection of the local server (0 for no limit)")
+    parser.add_argument("--titles", type=int, default=None,
+                        help="measure the title parsing over that many passes of the saved titles")
+    parser.add_argument("--listings", default=None,
+                        help="directory of the saved playlist listings (chefdata by default)")
+    args = parser.parse_args()
+
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    work_dir = tempfile.mkdtemp(prefix="kkchef-benchmark-")
+    try:
+        for filename in glob.glob(os.path.join(source_dir, "resources_*.json")):
+            shutil.copy(filename, work_dir)
+        os.chdir(work_dir)
+        if args.titles is not None:
+            corpus = saved_titles(args.listings or os.path.join(source_dir, "chefdata"))
+            if len(corpus) == 0:
+                raise SystemExit("No playlist listing saved, run the chef first or give --listings")
+            print(json.dumps(titles(args, corpus), indent=2))
+        elif args.download_mb is not None:
+            print(json.dumps(downloads(args), indent=2))
+        elif args.hash_files is not None:
+            print(json.dumps(hashing(args), indent=2))
+        elif args.index_videos is not None:
+            print(json.dumps(index_lookups(args), indent=2))
+        elif args.tree_videos is not None:
+            print(json.dumps(tree_memory(args), indent=2))
+        else:
+            print(json.dumps(run(args), indent=2))
+    finally:
+        os.chdir(source_dir)
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
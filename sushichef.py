@@ -1,31 +1,43 @@
 #!/usr/bin/env python
 
+import asyncio
 from bs4 import BeautifulSoup
+from cachecontrol.cache import BaseCache
 import codecs
-from collections import defaultdict, OrderedDict
+from collections import Counter, defaultdict, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 import copy
+import functools
 import glob
 from le_utils.constants import licenses, content_kinds, file_formats
 import hashlib
+import heapq
 import json
 import logging
 import ntpath
 import os
 from pathlib import Path
+from queue import Queue
+import random
 import re
 import requests
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 from ricecooker.classes.licenses import get_license
 from ricecooker.chefs import JsonTreeChef
 from ricecooker.utils import downloader, html_writer
-from ricecooker.utils.caching import CacheForeverHeuristic, FileCache, CacheControlAdapter
-from ricecooker.utils.jsontrees import write_tree_to_json_tree, SUBTITLES_FILE
+from ricecooker.utils.caching import CacheForeverHeuristic, CacheControlAdapter
+from ricecooker.utils.jsontrees import SUBTITLES_FILE
 import time
-from urllib.error import URLError
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse, parse_qs
 from utils import if_dir_exists, get_name_from_url, clone_repo, build_path
 from utils import if_file_exists, get_video_resolution_format, remove_links
-from utils import get_name_from_url_no_ext, get_node_from_channel, get_level_map
-from utils import remove_iframes, get_confirm_token, save_response_content
+from utils import get_name_from_url_no_ext, remove_iframes, get_confirm_token
+from utils import save_response_content, get_file_digests, read_json_lines, TreeIndex
 import youtube_dl
 
 
@@ -36,22 +48,14 @@ COPYRIGHT_HOLDER = "King Khaled University in Abha, Saudi Arabia"
 LICENSE = get_license(licenses.CC_BY, 
         copyright_holder=COPYRIGHT_HOLDER).as_dict()
 AUTHOR = "King Khaled University in Abha, Saudi Arabia"
+#values repeated in every node, shared by the nodes read back from disk
+SHARED_VALUES = ("kind", "language", "file_type", "author")
 
 LOGGER = logging.getLogger()
 __logging_handler = logging.StreamHandler()
 LOGGER.addHandler(__logging_handler)
 LOGGER.setLevel(logging.INFO)
 
-DOWNLOAD_VIDEOS = True
-LOAD_VIDEO_LIST = False
-
-sess = requests.Session()
-cache = FileCache('.webcache')
-basic_adapter = CacheControlAdapter(cache=cache)
-forever_adapter = CacheControlAdapter(heuristic=CacheForeverHeuristic(), cache=cache)
-sess.mount('http://', basic_adapter)
-sess.mount(BASE_URL, forever_adapter)
-
 # Run constants
 ################################################################################
 #CHANNEL_NAME = ""              # Name of channel
@@ -64,90 +68,1445 @@ CHANNEL_THUMBNAIL = "https://yt3.ggpht.com/a-/AN66SAz9fwCzHEBXcCczoBEGfXr7xKzhoo
 # Additional constants
 ################################################################################
 
-def title_has_numeration(title):
-    unit_name_ar = ["الوحده", "الوحدة"]
-    for unit_name in unit_name_ar:
-        if unit_name in title:
-            index = title.find(unit_name)
-            match = re.search("(?P<int>\d+)", title)
-            if match:
-                num = int(match.group("int"))
-                return title[index: index+len(unit_name)] + " " + str(num), num
+UNIT_WORDS = ("الوحده", "الوحدة")
+SINGLE_DIGITS = {digit: number for number, digit in enumerate("0123456789") if number > 0}
+SINGLE_DIGITS.update({digit: number for number, digit in enumerate("٠١٢٣٤٥٦٧٨٩") if number > 0})
+SPACES_RE = re.compile(" +")
+#a number, flagged when it's followed by "-<number>" (a range) or "<spaces><number>" (a pair)
+NUMBERS_RE = re.compile(r"(\d+)(?:(-)(?=\d)|\s+(?=\d))?")
+SPECIAL_CASE_RE = re.compile("مهارات في علم الرياضيات|-")
+
+
+def clean_video_title(title):
+    """Drops the "| unit |" part of the title, the math course name and the dashes."""
+    first, last = title.find("|"), title.rfind("|")
+    if first != last:
+        title = "{} | {}".format(title[:first].strip(), title[last + 1:].strip())
+    return SPECIAL_CASE_RE.sub("", title).strip()
+
+
+def parse_title(title):
+    """
+    Returns the unit name, unit number and cleaned title of a video title. The
+    unit comes from, in this order: the first "3-1" range, the first "3 1" pair,
+    the unit word (الوحدة) with the first number, a single digit word (Western
+    or Arabic-Indic), a last character that appears only once.
+    """
+    cleaned = clean_video_title(title)
+    title = SPACES_RE.sub(" ", title)
+    first_number = first_pair = None
+    for match in NUMBERS_RE.finditer(title):
+        if first_number is None:
+            first_number = match.group(1)
+        if match.group(2) is not None:
+            return "Unit {}".format(match.group(1)), int(match.group(1)), cleaned
+        if first_pair is None and match.end() > match.end(1):
+            first_pair = match.group(1)
+    if first_pair is not None:
+        return "Unit {}".format(first_pair), int(first_pair), cleaned
+
+    for unit_word in UNIT_WORDS:
+        if unit_word in title:
+            if first_number is not None:
+                return "{} {}".format(unit_word, int(first_number)), int(first_number), cleaned
+            return unit_word, 1, cleaned
+
+    words_title = title.replace("-", " ")
+    for word in words_title.split(" "):
+        word = word.strip()
+        if word in SINGLE_DIGITS:
+            return words_title.replace(word, "").strip(), SINGLE_DIGITS[word], cleaned
+    if words_title and words_title.find(words_title[-1]) == len(words_title) - 1:
+        return words_title.replace(words_title[-1], "").strip(), 1, cleaned
+    return title, 1, cleaned
+
+
+class Metrics(object):
+    """
+    Wall time, calls and counters (bytes, cache hits/misses, retries) of the
+    stages of the run, in total and per scope (subject / topic), written as a
+    json report next to the tree.
+    """
+    def __init__(self):
+        self.started_at = time.time()
+        self.stages = defaultdict(lambda: defaultdict(float))
+        self.scopes = defaultdict(lambda: defaultdict(lambda: defaultdict(float)))
+        self.extra = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, scope=None, **counters):
+        with self.lock:
+            for name, value in counters.items():
+                self.stages[stage][name] += value
+                if scope is not None:
+                    self.scopes[scope][stage][name] += value
+
+    @contextmanager
+    def timed(self, stage, scope=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, scope, calls=1, seconds=time.time() - start)
+
+    def report(self):
+        with self.lock:
+            return dict(
+                started_at=self.started_at,
+                wall_seconds=time.time() - self.started_at,
+                stages=self.stages,
+                scopes=self.scopes,
+                **self.extra
+            )
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2, ensure_ascii=False)
+
+
+METRICS = Metrics()
+
+
+def timed(stage):
+    """Records the calls of the method under `stage`, in the scope of the object."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with METRICS.timed(stage, getattr(self, "scope", None)):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class WebCache(BaseCache):
+    """
+    Cache of the http responses for cachecontrol, one file per url in 256 shard
+    directories. The entries not used for `max_age` seconds are removed, and the
+    least recently used ones beyond `max_bytes`; until then an entry cached
+    forever is served as before. The entries on disk are listed on first use.
+    """
+    def __init__(self, directory, max_bytes=512 * 2**20, max_age=30 * 86400):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        #path -> (size, last used), least recently used first
+        self.entries = None
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        self.bytes_stored = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        name = hashlib.sha224(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name[:2], name)
+
+    def load(self):
+        """Lists the entries on disk, called with the lock held."""
+        if self.entries is not None:
+            return
+        entries = []
+        if if_dir_exists(self.directory):
+            for shard in os.scandir(self.directory):
+                if not shard.is_dir():
+                    continue
+                if len(shard.name) != 2:
+                    #the nested directories of the previous FileCache
+                    LOGGER.info("Removing the previous web cache {}".format(shard.path))
+                    shutil.rmtree(shard.path, ignore_errors=True)
+                    continue
+                for entry in os.scandir(shard.path):
+                    if entry.name.endswith(".tmp"):
+                        os.remove(entry.path)
+                        continue
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+        entries.sort()
+        self.entries = OrderedDict((path, (size, used_at)) for used_at, path, size in entries)
+        self.size = sum(size for _, _, size in entries)
+        self.evict()
+
+    def evict(self):
+        """Removes the entries too old and the least recently used beyond the size."""
+        expired = time.time() - self.max_age
+        while len(self.entries) > 0:
+            path, (size, used_at) = next(iter(self.entries.items()))
+            if used_at >= expired and self.size <= self.max_bytes:
+                break
+            self.remove(path)
+            self.evictions += 1
+
+    def remove(self, path):
+        size, _ = self.entries.pop(path, (0, None))
+        self.size -= size
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key):
+        path = self.path(key)
+        with self.lock:
+            self.load()
+            if path not in self.entries or \
+                    self.entries[path][1] < time.time() - self.max_age:
+                self.misses += 1
+                return None
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+            #the modification time keeps the order for the eviction of the next runs
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            if path in self.entries:
+                self.entries[path] = (len(value), time.time())
+                self.entries.move_to_end(path)
+            self.hits += 1
+            self.bytes_served += len(value)
+        return value
+
+    def set(self, key, value, expires=None):
+        #the expiration is in the cached headers, cachecontrol checks it
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(path), delete=False,
+                suffix=".tmp") as f:
+            f.write(value)
+        os.replace(f.name, path)
+        with self.lock:
+            self.load()
+            size, _ = self.entries.pop(path, (0, None))
+            self.entries[path] = (len(value), time.time())
+            self.size += len(value) - size
+            self.bytes_stored += len(value)
+            self.evict()
+
+    def delete(self, key):
+        with self.lock:
+            self.load()
+            self.remove(self.path(key))
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                entries=len(self.entries or ()),
+                size=self.size,
+                cache_hits=self.hits,
+                cache_misses=self.misses,
+                bytes_served=self.bytes_served,
+                bytes_stored=self.bytes_stored,
+                evictions=self.evictions)
+
+    def log_stats(self):
+        stats = self.stats()
+        LOGGER.info("Web cache: {} hits, {} misses, {:.1f} MB served, {} entries ({:.1f} MB), {} evicted".format(
+            stats["cache_hits"], stats["cache_misses"], stats["bytes_served"] / 2**20,
+            stats["entries"], stats["size"] / 2**20, stats["evictions"]))
+
+
+sess = requests.Session()
+cache = WebCache('.webcache')
+basic_adapter = CacheControlAdapter(cache=cache)
+forever_adapter = CacheControlAdapter(heuristic=CacheForeverHeuristic(), cache=cache)
+sess.mount('http://', basic_adapter)
+sess.mount(BASE_URL, forever_adapter)
+
+
+class YoutubeDLBackend(object):
+    """Runs the extractions of YouTubeResource with youtube_dl."""
+    def __init__(self):
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def stats(self):
+        return dict(self.calls)
+
+    def extract(self, url, ydl_options, download=False):
+        with youtube_dl.YoutubeDL(ydl_options) as ydl:
+            ydl.add_default_info_extractors()
+            return ydl.extract_info(url, download=download)
+
+    def playlist(self, url, ydl_options):
+        self.count("playlists")
+        return self.extract(url, ydl_options)
+
+    def video_info(self, url, ydl_options):
+        self.count("videos")
+        return self.extract(url, ydl_options)
+
+    def download(self, url, ydl_options):
+        self.count("downloads")
+        return self.extract(url, ydl_options, download=True)
+
+    def subtitle(self, url):
+        self.count("subtitles")
+        response = sess.get(url)
+        response.raise_for_status()
+        return response.content
+
+
+BACKEND = YoutubeDLBackend()
+
+
+class CircuitBreaker(object):
+    """
+    Shared by all the download workers. When one of them is throttled the
+    breaker opens and every worker waits `cooldown` seconds before its next
+    request, the pause doubles (up to `max_cooldown`) while throttling goes on.
+    """
+    def __init__(self, cooldown=60, max_cooldown=900):
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.open_until = 0
+        self.consecutive = 0
+        self.trips = 0
+        self.lock = threading.Lock()
+
+    def trip(self):
+        with self.lock:
+            pause = min(self.max_cooldown, self.cooldown * 2 ** self.consecutive)
+            self.open_until = max(self.open_until, time.time() + pause)
+            self.consecutive += 1
+            self.trips += 1
+        LOGGER.info("    + Throttled, pausing the downloads {}s".format(pause))
+
+    def reset(self):
+        with self.lock:
+            self.consecutive = 0
+
+    def wait(self):
+        delay = self.open_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with full jitter. The errors are classified as transient
+    (retried), permanent (the video is not available, given up at once) or
+    rate-limited (retried after the circuit breaker pause).
+    """
+    TRANSIENT = "transient"
+    PERMANENT = "permanent"
+    RATE_LIMITED = "rate-limited"
+    #the messages have the video id and url, a bare "429" may be part of them
+    RATE_LIMITED_MESSAGES = ("http error 429", "too many requests", "rate limit",
+        "unusual traffic")
+    #"HTTP Error 503: Service Unavailable" is not a video that is unavailable
+    TRANSIENT_MESSAGES = ("http error 5",)
+    PERMANENT_MESSAGES = ("unavailable", "not available", "private video", "removed",
+        "copyright", "does not exist", "sign in to confirm your age", "terminated")
+
+    def __init__(self, breaker, attempts=4, base_delay=.8, max_delay=60):
+        self.breaker = breaker
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    def classify(self, error):
+        message = str(error).lower()
+        if any(text in message for text in RetryPolicy.RATE_LIMITED_MESSAGES):
+            return RetryPolicy.RATE_LIMITED
+        if any(text in message for text in RetryPolicy.TRANSIENT_MESSAGES):
+            return RetryPolicy.TRANSIENT
+        if isinstance(error, (youtube_dl.utils.DownloadError, youtube_dl.utils.ExtractorError)) and\
+            any(text in message for text in RetryPolicy.PERMANENT_MESSAGES):
+            return RetryPolicy.PERMANENT
+        return RetryPolicy.TRANSIENT
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def backoff(self, error, attempt):
+        """
+        Waits before the attempt that follows `attempt`, returns False if there is
+        none. A rate-limited error trips the breaker even after the last attempt.
+        """
+        if error == RetryPolicy.RATE_LIMITED:
+            self.breaker.trip()
+        if attempt + 1 >= self.attempts:
+            return False
+        with self.lock:
+            self.retries += 1
+        if error != RetryPolicy.RATE_LIMITED:
+            time.sleep(self.delay(attempt))
+        return True
+
+
+RETRY_POLICY = RetryPolicy(CircuitBreaker())
+
+
+class PlaylistCache(object):
+    """
+    Playlist listings saved in <directory>/<playlist id>.json, the directory
+    of the channel that lists them (ChannelConfig.playlists_dir), with the time
+    they were fetched and the duration of the videos. A listing younger than
+    `ttl` seconds is used as is, one stale by less than `stale` seconds is used
+    and refreshed in the background, an older one is listed again. The background
+    refresh is saved apart in <playlist id>.pending.json: the saved listing stays
+    the one the tree of the run was built from (the baseline of --incremental),
+    and the next run that builds its tree from the refresh promotes it, unless
+    `promote` is False. The files of the playlists not used by the run are
+    evicted, least recently used first, beyond `max_orphans`.
+    """
+    def __init__(self, ttl=86400, stale=604800, max_orphans=100):
+        self.ttl = ttl
+        self.stale = stale
+        self.max_orphans = max_orphans
+        self.promote = True
+        #video url -> duration in seconds, of all the listings read
+        self.durations = {}
+        self.used = set()
+        self.directories = set()
+        self.refreshes = []
+        self.executor = ThreadPoolExecutor(max_workers=2)
+
+    def path(self, playlist_id, directory, pending=False):
+        base_path = build_path([directory])
+        if re.match(r"^[\w-]+$", playlist_id) is None:
+            playlist_id = hashlib.sha1(playlist_id.encode("utf-8")).hexdigest()
+        return os.path.join(base_path, "{}{}.json".format(playlist_id,
+                            ".pending" if pending else ""))
+
+    def read(self, playlist_id, directory, pending=False):
+        try:
+            with open(self.path(playlist_id, directory, pending), "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def write(self, playlist_id, directory, name_url, durations, pending=False):
+        path = self.path(playlist_id, directory, pending)
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), delete=False,
+                suffix=".tmp") as f:
+            json.dump(dict(fetched_at=time.time(), videos=name_url, durations=durations), f)
+        os.replace(f.name, path)
+        if not pending:
+            #a refresh of a previous run is older than this listing
+            self.remove(self.path(playlist_id, directory, pending=True))
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def promote_pending(self, playlist_id, directory):
+        """
+        The listing refreshed in the background by a previous run, saved as the
+        listing of the playlist. None if there is none.
+        """
+        entry = self.read(playlist_id, directory, pending=True)
+        if entry is not None:
+            os.replace(self.path(playlist_id, directory, pending=True),
+                        self.path(playlist_id, directory))
+        return entry
+
+    def get(self, youtube, playlist_id, directory, entry):
+        """
+        Listing of the playlist, `entry` is the one read from disk (or None).
+        """
+        self.used.add(self.path(playlist_id, directory))
+        self.used.add(self.path(playlist_id, directory, pending=True))
+        self.directories.add(directory)
+        if self.promote:
+            entry = self.promote_pending(playlist_id, directory) or entry
+        if entry is None:
+            METRICS.add("playlist_cache", cache_misses=1)
+            return self.refresh(youtube, playlist_id, directory)
+
+        self.durations.update(entry.get("durations", {}))
+        age = time.time() - entry["fetched_at"]
+        if age <= self.ttl:
+            METRICS.add("playlist_cache", cache_hits=1)
+            #the modification time keeps the order for the eviction
+            os.utime(self.path(playlist_id, directory))
+        elif age <= self.ttl + self.stale:
+            METRICS.add("playlist_cache", cache_hits=1, stale=1)
+            LOGGER.info("    - Refreshing the playlist in the background")
+            self.refreshes.append(self.executor.submit(self.refresh, youtube, playlist_id,
+                                directory, pending=True))
+        else:
+            METRICS.add("playlist_cache", cache_misses=1, expired=1)
+            return self.refresh(youtube, playlist_id, directory)
+        return entry["videos"]
+
+    def refresh(self, youtube, playlist_id, directory, pending=False):
+        durations = {}
+        name_url = youtube.playlist_name_links(durations)
+        self.durations.update(durations)
+        #an empty listing is most likely a network error, the saved one is kept
+        if len(name_url) > 0:
+            self.write(playlist_id, directory, name_url, durations, pending)
+        return name_url
+
+    def close(self):
+        for refresh in self.refreshes:
+            try:
+                refresh.result()
+            except Exception as e:
+                LOGGER.info("Playlist refresh failed: {}".format(e))
+        self.refreshes = []
+
+    def evict(self):
+        orphans = [path for directory in self.directories
+                    for path in glob.glob(os.path.join(directory, "*.json"))
+                    if path not in self.used]
+        orphans.sort(key=os.path.getmtime, reverse=True)
+        for path in orphans[self.max_orphans:]:
+            LOGGER.info("Evicting playlist {}".format(path))
+            os.remove(path)
+
+
+class MetadataResolver(object):
+    """
+    Fans out blocking extractions with asyncio. The youtube_dl calls run in a
+    thread pool, at most `concurrency` at a time, and no more than `rate`
+    requests per second are started against the same host (no limit if None).
+    """
+    def __init__(self, concurrency=8, rate=None):
+        self.concurrency = concurrency
+        self.rate = rate
+
+    def map(self, func, urls):
+        """Returns [func(url) for url in urls], resolved concurrently."""
+        return asyncio.run(self.gather(func, urls))
+
+    async def gather(self, func, urls):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.host_locks = defaultdict(asyncio.Lock)
+        self.next_start = defaultdict(float)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return await asyncio.gather(*[self.run(executor, func, url) for url in urls])
+
+    async def run(self, executor, func, url):
+        async with self.semaphore:
+            await self.throttle(urlparse(url).netloc)
+            return await asyncio.get_running_loop().run_in_executor(executor, func, url)
+
+    async def throttle(self, host):
+        if not self.rate:
+            return
+        async with self.host_locks[host]:
+            now = asyncio.get_running_loop().time()
+            start = max(now, self.next_start[host])
+            self.next_start[host] = start + 1. / self.rate
+            if start > now:
+                await asyncio.sleep(start - now)
+
+
+class PlaylistRegistry(object):
+    """
+    Playlist listings resolved in this run, keyed by the playlist id (the list=
+    parameter of the url), so every playlist is listed only once no matter how
+    many units reference it. A listing in progress is waited for, not repeated.
+    A failed or empty listing is not kept, the next unit lists it again.
+    """
+    def __init__(self, cache, resolver=None):
+        self.cache = cache
+        self.resolver = resolver if resolver is not None else MetadataResolver()
+        self.playlists = {}
+        self.previous = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def playlist_id(self, url):
+        query = parse_qs(urlparse(url).query)
+        if "list" in query:
+            return query["list"][0]
+        return url.strip().rstrip("/")
+
+    def name_links(self, url, directory):
+        """
+        Listing of the playlist of `url`, cached in `directory` when it's listed
+        by this call.
+        """
+        playlist_id = PlaylistRegistry.playlist_id(url)
+        with self.lock:
+            listing = self.playlists.get(playlist_id)
+            resolved = listing is not None
+            if resolved:
+                self.hits += 1
             else:
-                return title[index: index+len(unit_name)], None 
-    
-    numbers = list(map(str, [1,2,3,4,5,6,7,8,9]))
-    arab_nums = ["١", "٢", "٣", "٤", "٥"]
-    title = title.replace("-", " ")
-    for elem in title.split(" "):
-        elem = elem.strip()
-        for num in numbers:
-            if elem == num:
-                return title.replace(elem, "").strip(), int(num)
-    
-    for arab_num in title:
-        index = title.find(arab_num)
-        if index != -1 and index >= len(title) - 1:
-            return title.replace(arab_num, "").strip(), 1
-    
-    return False, None
-
-
-def title_patterns(title):
-    title = re.sub(' +', ' ' , title)
-    pattern01 = r"\d+\-\d+"
-    match = re.search(pattern01, title)
-    if match:
-        index = match.span()
-        numbers = title[index[0]:index[1]]
-        number_unit = numbers.split("-")[0].strip()
-        return "Unit {}".format(number_unit), int(number_unit)
-    
-    pattern02 = r"\d+\s+\d+"
-    match = re.search(pattern02, title)
-    if match:
-        index = match.span()
-        numbers = title[index[0]:index[1]]
-        number_unit = int(title[index[1]:].strip())
-        return "Unit {}".format(number), number_unit
-    
-    title_unit, unit_num = title_has_numeration(title)
-    if title_unit is not False and unit_num is not None:
-        return title_unit, unit_num
-    elif title_unit is not False and unit_num is None:
-        return title_unit, 1
-    else:
-        return title, 1
+                self.misses += 1
+                listing = self.playlists[playlist_id] = Future()
+        if resolved:
+            METRICS.add("playlists", cache_hits=1)
+            return listing.result()
+
+        METRICS.add("playlists", cache_misses=1)
+        try:
+            entry = self.cache.read(playlist_id, directory)
+            self.previous[playlist_id] = entry["videos"] if entry is not None else None
+            name_url = self.cache.get(YouTubeResource(url), playlist_id, directory, entry)
+        except Exception as e:
+            with self.lock:
+                del self.playlists[playlist_id]
+            listing.set_exception(e)
+            raise
+        previous = self.previous[playlist_id]
+        if len(name_url) == 0 and previous:
+            #the videos of a listing that failed are not removed from the tree
+            LOGGER.info("    - Listing failed, the previous one is used: {}".format(url))
+            name_url = previous
+        #an empty listing is most likely a failed one, it's shared with the calls
+        #waiting for it but the next call lists the playlist again
+        if len(name_url) == 0:
+            with self.lock:
+                del self.playlists[playlist_id]
+        listing.set_result(name_url)
+        return name_url
+
+    def prefetch(self, sources):
+        """
+        Lists concurrently the playlists not resolved yet, `sources` are
+        (url, directory) pairs as taken by name_links.
+        """
+        pending = OrderedDict()
+        for url, directory in sources:
+            playlist_id = PlaylistRegistry.playlist_id(url)
+            if playlist_id not in self.playlists and playlist_id not in pending:
+                pending[playlist_id] = (url, directory)
+        if len(pending) > 0:
+            directories = OrderedDict(pending.values())
+            self.resolver.map(lambda url: self.name_links(url, directories[url]),
+                            list(directories))
+
+    def diff(self, playlist_ids):
+        """
+        Compares the listings of this run with the ones saved by the previous run,
+        returns the urls of the added (or renamed), removed and unchanged videos.
+        A playlist that could not be listed is unchanged.
+        """
+        added, removed, unchanged = set(), set(), set()
+        for playlist_id in playlist_ids:
+            listing = self.playlists.get(playlist_id)
+            previous = set(map(tuple, self.previous.get(playlist_id) or []))
+            current = previous
+            if listing is not None and listing.done() and listing.exception() is None:
+                current = set(map(tuple, listing.result())) or previous
+            unchanged |= {url for _, url in current & previous}
+            added |= {url for _, url in current - previous}
+            removed |= {url for _, url in previous} - {url for _, url in current}
+        return added, removed, unchanged
+
+    def log_stats(self):
+        LOGGER.info("Playlists: {} listed, {} hits, {} misses".format(
+            len(self.playlists), self.hits, self.misses))
+
+
+PLAYLISTS = PlaylistRegistry(PlaylistCache())
+
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.
+        self.max_depth = 0
+
+    def __str__(self):
+        return "{}: {} items in {:.1f}s ({:.2f} items/s), max queue depth {}".format(
+            self.name, self.items, self.busy, self.items / self.busy if self.busy else 0,
+            self.max_depth)
+
+
+class Pipeline(object):
+    """
+    Chain of stages, each one running in its own thread and connected to the
+    next one by a bounded queue. A stage is a function that takes an item of
+    the previous stage and yields its own items, in order.
+    """
+    DONE = object()
+
+    class Failure(object):
+        def __init__(self, error):
+            self.error = error
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.stats = []
+
+    def stage(self, name, func, items):
+        """Runs `func` over `items` in a thread, returns an iterator of its outputs."""
+        stats = StageStats(name)
+        self.stats.append(stats)
+        queue = Queue(maxsize=self.maxsize)
+
+        def run():
+            try:
+                for item in items:
+                    start = time.time()
+                    for output in func(item):
+                        stats.busy += time.time() - start
+                        queue.put(output)
+                        stats.items += 1
+                        stats.max_depth = max(stats.max_depth, queue.qsize())
+                        start = time.time()
+                    stats.busy += time.time() - start
+            except Exception as e:
+                queue.put(Pipeline.Failure(e))
+            queue.put(Pipeline.DONE)
+
+        threading.Thread(target=run, name=name, daemon=True).start()
+        return self.drain(queue)
+
+    def drain(self, queue):
+        while True:
+            item = queue.get()
+            if item is Pipeline.DONE:
+                return
+            if isinstance(item, Pipeline.Failure):
+                raise item.error
+            yield item
+
+    def consume(self, name, func, items):
+        """Runs the last stage in the calling thread."""
+        stats = StageStats(name)
+        self.stats.append(stats)
+        for item in items:
+            start = time.time()
+            func(item)
+            stats.busy += time.time() - start
+            stats.items += 1
+
+    def log_stats(self):
+        for stats in self.stats:
+            LOGGER.info("Stage {}".format(stats))
+
+
+class DownloadScheduler(object):
+    """
+    Runs the downloads on `workers` threads, the smallest estimated first, so a
+    long lecture doesn't hold back the short ones queued behind it. The size is
+    estimated from the duration at `bitrate` bytes per second (`default_duration`
+    if it's unknown). At most `max_bytes` estimated bytes are downloaded at a time
+    (None for no limit). A download starts with an even share of the `bandwidth`
+    cap in bytes per second (None for no cap) between the downloads that can run
+    with it, and holds it until it's done, so the running downloads never go over
+    the cap together; a download waits while the shares held leave less than its
+    own. youtube_dl fixes the rate when the download starts: the share of a long
+    download is not raised when the others finish. The throughput and the ETA are
+    logged every `report_interval` seconds.
+    """
+    def __init__(self, workers=1, bandwidth=None, max_bytes=None, bitrate=62500,
+            default_duration=600, report_interval=10):
+        self.bandwidth = bandwidth
+        self.max_bytes = max_bytes
+        self.bitrate = bitrate
+        self.default_duration = default_duration
+        self.report_interval = report_interval
+        self.queue = []
+        self.sequence = 0
+        self.running = 0
+        self.running_bytes = 0
+        self.allocated = 0
+        self.queued_bytes = 0
+        self.done = 0
+        self.downloaded = 0
+        self.downloaded_estimate = 0
+        self.started_at = time.time()
+        self.reported_at = self.started_at
+        self.closed = False
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self.work, name="download-{}".format(i),
+                        daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def estimate(self, duration):
+        return int((duration or self.default_duration) * self.bitrate)
+
+    def submit(self, func, *args, duration=None, **kwargs):
+        """
+        Queues func(*args, ratelimit=<bytes per second or None>, **kwargs), which
+        returns the number of bytes it downloaded. Returns its Future.
+        """
+        future = Future()
+        size = self.estimate(duration)
+        with self.condition:
+            heapq.heappush(self.queue, (size, self.sequence, future, func, args, kwargs))
+            self.sequence += 1
+            self.queued_bytes += size
+            self.condition.notify()
+        return future
+
+    def fits(self, running, running_bytes, size):
+        #the budget is checked only against running downloads, a bigger job runs alone
+        return self.max_bytes is None or running == 0 or running_bytes + size <= self.max_bytes
+
+    def concurrency(self):
+        """The downloads that can run with the next job, itself included."""
+        running, running_bytes = self.running, self.running_bytes
+        for size, *_ in heapq.nsmallest(len(self.threads) - self.running, self.queue):
+            if not self.fits(running, running_bytes, size):
+                break
+            running += 1
+            running_bytes += size
+        return running
+
+    def next_job(self):
+        """The next job and its ratelimit, None if it must wait."""
+        if len(self.queue) == 0 or not self.fits(self.running, self.running_bytes,
+                                                    self.queue[0][0]):
+            return None
+        ratelimit = None
+        if self.bandwidth:
+            ratelimit = self.bandwidth / self.concurrency()
+            #with a small tolerance for the rounding of the shares
+            if self.bandwidth - self.allocated < ratelimit * .999:
+                return None
+            ratelimit = min(ratelimit, self.bandwidth - self.allocated)
+        return heapq.heappop(self.queue) + (ratelimit,)
+
+    def work(self):
+        while True:
+            with self.condition:
+                job = self.next_job()
+                while job is None:
+                    if self.closed and len(self.queue) == 0:
+                        return
+                    self.condition.wait()
+                    job = self.next_job()
+                size, _, future, func, args, kwargs, ratelimit = job
+                self.queued_bytes -= size
+                self.running += 1
+                self.running_bytes += size
+                self.allocated += ratelimit or 0
+
+            downloaded = 0
+            if future.set_running_or_notify_cancel():
+                try:
+                    downloaded = func(*args, ratelimit=ratelimit, **kwargs) or 0
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(downloaded)
+
+            with self.condition:
+                self.running -= 1
+                self.running_bytes -= size
+                self.allocated -= ratelimit or 0
+                self.done += 1
+                self.downloaded += downloaded
+                if downloaded > 0:
+                    self.downloaded_estimate += size
+                self.condition.notify_all()
+                report = time.time() - self.reported_at >= self.report_interval
+                if report:
+                    self.reported_at = time.time()
+            if report:
+                self.log_stats()
+
+    def stats(self):
+        with self.condition:
+            seconds = time.time() - self.started_at
+            throughput = self.downloaded / seconds if seconds else 0
+            #the estimates are corrected by how far they were from the downloaded sizes
+            remaining = self.queued_bytes + self.running_bytes
+            if self.downloaded_estimate > 0:
+                remaining = remaining * self.downloaded / self.downloaded_estimate
+            return dict(
+                done=self.done,
+                queued=len(self.queue),
+                running=self.running,
+                downloaded_bytes=self.downloaded,
+                seconds=seconds,
+                bytes_per_second=throughput,
+                eta_seconds=remaining / throughput if throughput else None)
+
+    def log_stats(self):
+        stats = self.stats()
+        LOGGER.info("Downloads: {} done, {} running, {} queued, {:.2f} MB/s, ETA {}".format(
+            stats["done"], stats["running"], stats["queued"], stats["bytes_per_second"] / 2**20,
+            "{:.0f}s".format(stats["eta_seconds"]) if stats["eta_seconds"] is not None else "-"))
+
+    def shutdown(self, wait=True):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+
+class VideoStore(object):
+    """
+    Manifest of the videos downloaded into a directory, keyed by the video id.
+    Each entry has the path, size, format, sha1, fetched_at and the subset of
+    the info dict needed to build the node, so a complete file is reused
+    without any network call. The entries are appended to the manifest, the
+    last line of a video wins; it's compacted when it's loaded.
+    """
+    #one json line per downloaded video
+    MANIFEST = "manifest.jsonl"
+    stores = {}
+    stores_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest_path = os.path.join(path, VideoStore.MANIFEST)
+        self.lock = threading.Lock()
+        self.videos = self.read()
+        self.manifest = open(self.manifest_path, "a")
+
+    @classmethod
+    def get(self, path):
+        with VideoStore.stores_lock:
+            if path not in VideoStore.stores:
+                VideoStore.stores[path] = VideoStore(path)
+            return VideoStore.stores[path]
 
+    @classmethod
+    def close_all(self):
+        """Closes the manifests of the stores, the next get reads them again."""
+        with VideoStore.stores_lock:
+            for store in VideoStore.stores.values():
+                store.close()
+            VideoStore.stores = {}
+
+    def read(self):
+        videos = {}
+        lines = 0
+        for record in read_json_lines(self.manifest_path):
+            videos[record["id"]] = record["entry"]
+            lines += 1
+        if lines > 2 * len(videos):
+            self.compact(videos)
+        return videos
+
+    def compact(self, videos):
+        """
+        Rewrites the manifest with the last entry of each video. It's replaced in
+        one step, an interrupted write leaves the previous version in place.
+        """
+        with tempfile.NamedTemporaryFile("w", dir=self.path, delete=False,
+                prefix=VideoStore.MANIFEST, suffix=".tmp") as f:
+            for video_id, entry in videos.items():
+                f.write(json.dumps(dict(id=video_id, entry=entry)) + "\n")
+        os.replace(f.name, self.manifest_path)
+
+    def check(self, video_id):
+        """
+        Returns the entry if the file is complete, a truncated file is removed
+        so that it's fetched again.
+        """
+        with self.lock:
+            entry = self.videos.get(video_id)
+        if entry is None:
+            return None
+        try:
+            size = os.path.getsize(entry["path"])
+        except OSError:
+            return None
+        if size == entry["size"] and size > 0:
+            return entry
+        LOGGER.info("    + Truncated file {}".format(entry["path"]))
+        os.remove(entry["path"])
+
+    def add(self, video_id, filepath, info):
+        entry = dict(
+            path=filepath,
+            size=os.path.getsize(filepath),
+            format=info.get("format_id"),
+            sha1=HASHES.digest(filepath)["sha1"],
+            fetched_at=time.time(),
+            info=dict(
+                id=info["id"],
+                title=info["title"],
+                width=info.get("width"),
+                height=info.get("height"),
+                #the track urls are signed and expire, only the format to fetch is kept
+                subtitles={language: [dict(ext=track["ext"]) for track in SubtitleCache.best(formats)]
+                            for language, formats in info.get("subtitles", {}).items()})
+        )
+        with self.lock:
+            self.videos[video_id] = entry
+            self.manifest.write(json.dumps(dict(id=video_id, entry=entry)) + "\n")
+            self.manifest.flush()
+        return entry
+
+    def close(self):
+        with self.lock:
+            self.manifest.close()
+
+
+class HashIndex(object):
+    """
+    Digests (sha1) of the local files keyed by (path, size, mtime), so
+    a file that didn't change since it was hashed is never read again. The
+    missing digests are computed from memory-mapped reads, `workers` files at
+    a time. Until `open` is called the digests are only kept in memory.
+    """
+    #one json line per hashed file, appended, the last line wins
+    INDEX = "hashes.jsonl"
+    #the store and the transcoder use the sha1, ricecooker hashes the files it uploads
+    ALGORITHMS = ("sha1",)
+
+    def __init__(self):
+        self.path = None
+        self.digests = {}
+        self.pending = {}
+        self.index = None
+        self.executor = None
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self.seconds = 0.
+        self.lock = threading.Lock()
+
+    def open(self, path, workers=None):
+        self.path = path
+        self.digests = self.read()
+        self.index = open(os.path.join(self.path, HashIndex.INDEX), "a")
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+
+    @staticmethod
+    def key(filepath):
+        stat = os.stat(filepath)
+        return os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns
+
+    def read(self):
+        return {tuple(record["key"]): record["digests"]
+                for record in read_json_lines(os.path.join(self.path, HashIndex.INDEX))}
+
+    def known(self, filepath):
+        """The digests of the file if it's unchanged since it was hashed, never reads it."""
+        try:
+            key = HashIndex.key(filepath)
+        except OSError:
+            return None
+        with self.lock:
+            return self.digests.get(key)
+
+    def digest(self, filepath):
+        """The digests of the file, computed only if it changed or was never hashed."""
+        return self.submit(filepath).result()
+
+    def submit(self, filepath):
+        """Returns the Future of the digests, a file is hashed once even if asked twice."""
+        key = HashIndex.key(filepath)
+        with self.lock:
+            if key in self.digests:
+                self.hits += 1
+                future = Future()
+                future.set_result(self.digests[key])
+                return future
+            if key in self.pending:
+                return self.pending[key]
+            future = self.pending[key] = Future()
+        try:
+            if self.executor is not None:
+                self.executor.submit(self.compute, key, future)
+            else:
+                self.compute(key, future)
+        except RuntimeError as e:
+            future.set_exception(e)
+        return future
+
+    def compute(self, key, future):
+        filepath, size, _ = key
+        start = time.time()
+        try:
+            digests = get_file_digests(filepath, HashIndex.ALGORITHMS)
+            #a file changed while it was read gets a new key, the digests are not kept
+            unchanged = HashIndex.key(filepath) == key
+        except Exception as e:
+            with self.lock:
+                del self.pending[key]
+            future.set_exception(e)
+            return
+        with self.lock:
+            del self.pending[key]
+            self.misses += 1
+            self.bytes += size
+            self.seconds += time.time() - start
+            if unchanged:
+                self.digests[key] = digests
+                if self.index is not None:
+                    self.index.write(json.dumps(dict(key=key, digests=digests)) + "\n")
+                    self.index.flush()
+        future.set_result(digests)
+
+    def update(self, filepaths):
+        """Hashes in parallel the files not hashed yet, returns their digests."""
+        futures = []
+        for filepath in filepaths:
+            try:
+                futures.append(self.submit(filepath))
+            except OSError:
+                continue
+        digests = []
+        for future in futures:
+            try:
+                digests.append(future.result())
+            except OSError as e:
+                LOGGER.info("    + Hashing failed: {}".format(e))
+        return digests
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                files=len(self.digests),
+                cache_hits=self.hits,
+                cache_misses=self.misses,
+                bytes=self.bytes,
+                bytes_per_second=self.bytes / self.seconds if self.seconds else 0)
 
-def remove_units_number(title):
-    match = re.search(r'\|.*\|', title)
-    if match:
-        index = match.span()
-        new_title = "{} | {}".format(title[:index[0]].strip(), title[index[1]:].strip())
-        return new_title.strip()
-    return title
+    def log_stats(self):
+        stats = self.stats()
+        LOGGER.info("Hashes: {} files hashed ({:.1f} MB), {} unchanged files not read".format(
+            stats["cache_misses"], stats["bytes"] / 2**20, stats["cache_hits"]))
 
 
-def remove_special_case(title):
-    title = title.replace("مهارات في علم الرياضيات", "")
-    title = title.replace("-", "")
-    return title.strip()
+HASHES = HashIndex()
+
+
+class SubtitleCache(object):
+    """
+    Subtitle tracks fetched by the chef, stored once per content as <sha1>.<ext>
+    and indexed by video id and language, so the re-runs and the upload never
+    fetch them again. Only the `languages` allowed (all if None) are fetched,
+    `workers` tracks at a time. Until `open` is called nothing is fetched.
+    """
+    #one json line per fetched track, appended, the last line wins
+    INDEX = "index.jsonl"
+    #formats ricecooker converts, the first offered is fetched
+    FORMATS = ("vtt", "srt", "ttml")
+
+    def __init__(self):
+        self.path = None
+        self.languages = None
+        self.tracks = {}
+        self.index = None
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def open(self, path, languages=None, workers=4):
+        self.path = path
+        self.languages = languages
+        self.tracks = self.read()
+        self.index = open(os.path.join(self.path, SubtitleCache.INDEX), "a")
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    @staticmethod
+    def key(video_id, language):
+        return "{}:{}".format(video_id, language)
+
+    @staticmethod
+    def best(formats):
+        """The track to fetch among the formats of a language, in a list as youtube_dl does."""
+        formats = [track for track in formats
+                    if track.get("ext") in SubtitleCache.FORMATS and track.get("url")]
+        formats.sort(key=lambda track: SubtitleCache.FORMATS.index(track["ext"]))
+        return [dict(ext=track["ext"], url=track["url"]) for track in formats[:1]]
+
+    def allowed(self, language):
+        return self.languages is None or language in self.languages
+
+    def missing(self, video_id, subtitles):
+        """The allowed languages of `subtitles` with a track to fetch that isn't cached."""
+        if self.path is None:
+            return []
+        return [language for language, formats in subtitles.items()
+                if self.allowed(language) and len(formats) > 0 and
+                self.get(video_id, language) is None]
+
+    def read(self):
+        return {record["key"]: record["track"]
+                for record in read_json_lines(os.path.join(self.path, SubtitleCache.INDEX))}
+
+    def get(self, video_id, language):
+        """Returns (path, format) of the cached track, None if it's not fetched."""
+        if self.path is None:
+            return None
+        with self.lock:
+            entry = self.tracks.get(SubtitleCache.key(video_id, language))
+        if entry is None:
+            return None
+        path = os.path.join(self.path, "{}.{}".format(entry["sha1"], entry["ext"]))
+        if if_file_exists(path):
+            return path, entry["ext"]
+
+    def fetch(self, video_id, subtitles):
+        """
+        Fetches in parallel the allowed tracks of `subtitles` (language -> formats)
+        not cached yet. A track that fails is left to ricecooker.
+        """
+        if self.path is None:
+            return
+        pending = []
+        for language, formats in subtitles.items():
+            formats = SubtitleCache.best(formats)
+            if not self.allowed(language) or len(formats) == 0:
+                continue
+            if self.get(video_id, language) is not None:
+                METRICS.add("subtitles", cache_hits=1)
+                continue
+            pending.append((language, self.executor.submit(self.fetch_track, video_id,
+                            language, formats[0])))
+        for language, future in pending:
+            try:
+                future.result()
+            except Exception as e:
+                LOGGER.info("    + Subtitle {} failed: {}".format(language, e))
+
+    def fetch_track(self, video_id, language, track):
+        content = BACKEND.subtitle(track["url"])
+        sha1 = hashlib.sha1(content).hexdigest()
+        path = os.path.join(self.path, "{}.{}".format(sha1, track["ext"]))
+        if not if_file_exists(path):
+            with tempfile.NamedTemporaryFile("wb", dir=self.path, delete=False,
+                    suffix=".tmp") as f:
+                f.write(content)
+            os.replace(f.name, path)
+        METRICS.add("subtitles", cache_misses=1, bytes=len(content))
+        key = SubtitleCache.key(video_id, language)
+        entry = dict(sha1=sha1, ext=track["ext"])
+        with self.lock:
+            self.tracks[key] = entry
+            self.index.write(json.dumps(dict(key=key, track=entry)) + "\n")
+            self.index.flush()
+
+
+SUBTITLES = SubtitleCache()
+
+
+#ffmpeg settings of the --transcode profiles
+TRANSCODE_PROFILES = {
+    "low": dict(height=360, crf=30, preset="medium", audio_bitrate="64k"),
+    "medium": dict(height=480, crf=26, preset="medium", audio_bitrate="96k"),
+}
+
+
+class Transcoder(object):
+    """
+    Compresses the downloaded videos with the local ffmpeg, one single-threaded
+    ffmpeg process per core at a time. The results are saved as
+    <sha1 of the source>.<profile>.mp4, so a video is compressed only once per
+    profile; a result bigger than its source is not used. Until `open` is
+    called, or without ffmpeg, the videos are left as downloaded.
+    """
+    def __init__(self):
+        self.path = None
+        self.profile = None
+        self.workers = 0
+        self.executor = None
+        self.jobs = 0
+        self.seconds = 0.
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lock = threading.Lock()
+
+    def open(self, path, profile, workers=None):
+        if profile not in TRANSCODE_PROFILES:
+            raise ValueError("Unknown transcode profile {}, use one of {}".format(
+                profile, ", ".join(sorted(TRANSCODE_PROFILES))))
+        if shutil.which("ffmpeg") is None:
+            LOGGER.info("ffmpeg not found, the videos are not transcoded")
+            return
+        self.path = path
+        self.profile = profile
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    @property
+    def enabled(self):
+        return self.executor is not None
+
+    @property
+    def profile_key(self):
+        settings = json.dumps(TRANSCODE_PROFILES[self.profile], sort_keys=True)
+        return "{}-{}".format(self.profile, hashlib.sha1(settings.encode("utf-8")).hexdigest()[:8])
+
+    def submit(self, youtube):
+        return self.executor.submit(self.transcode, youtube)
+
+    @timed("transcode")
+    def transcode(self, youtube):
+        """
+        Replaces youtube.filepath by its compressed version, the video is left as
+        downloaded if that fails. A video is compressed once per run, the units
+        that share it (VideoRegistry.submit) get the same result.
+        """
+        try:
+            output, _ = VIDEOS.run("transcodes", youtube.video_id or youtube.filepath,
+                                    lambda: self.compress(youtube))
+        except Exception as e:
+            LOGGER.info("    + Transcoding failed {}: {}".format(youtube.filepath, e))
+            return
+        if output is not None:
+            youtube.filepath = output
+
+    def compress(self, youtube):
+        """The path of the compressed video, None if it's not used."""
+        source = youtube.filepath
+        entry = VideoStore.get(os.path.dirname(source)).check(youtube.video_id)
+        sha1 = entry["sha1"] if entry is not None else HASHES.digest(source)["sha1"]
+        output = os.path.join(self.path, "{}.{}.mp4".format(sha1, self.profile_key))
+        size = os.path.getsize(source)
+        if if_file_exists(output):
+            METRICS.add("transcode", youtube.scope, cache_hits=1)
+        else:
+            METRICS.add("transcode", youtube.scope, cache_misses=1)
+            start = time.time()
+            if not self.ffmpeg(source, output):
+                return None
+            with self.lock:
+                self.jobs += 1
+                self.seconds += time.time() - start
+                self.bytes_in += size
+                self.bytes_out += os.path.getsize(output)
+        if os.path.getsize(output) < size:
+            METRICS.add("transcode", youtube.scope, bytes_saved=size - os.path.getsize(output))
+            HASHES.submit(output)
+            return output
+
+    def ffmpeg(self, source, output):
+        settings = TRANSCODE_PROFILES[self.profile]
+        with tempfile.NamedTemporaryFile(dir=self.path, delete=False, suffix=".mp4") as f:
+            tmp = f.name
+        command = ["ffmpeg", "-nostdin", "-y", "-loglevel", "error", "-i", source,
+            "-c:v", "libx264", "-preset", settings["preset"], "-crf", str(settings["crf"]),
+            "-vf", "scale=-2:'min({},ih)'".format(settings["height"]),
+            "-c:a", "aac", "-b:a", settings["audio_bitrate"],
+            "-threads", "1", "-movflags", "+faststart", tmp]
+        try:
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE)
+        except (subprocess.CalledProcessError, OSError) as e:
+            LOGGER.info("    + Transcoding failed {}: {}".format(source, getattr(e, "stderr", e)))
+            os.remove(tmp)
+            return False
+        os.replace(tmp, output)
+        return True
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                profile=self.profile,
+                workers=self.workers,
+                jobs=self.jobs,
+                bytes_in=self.bytes_in,
+                bytes_out=self.bytes_out,
+                bytes_saved=self.bytes_in - self.bytes_out,
+                bytes_per_second_per_core=self.bytes_in / self.seconds if self.seconds else 0)
+
+    def log_stats(self):
+        stats = self.stats()
+        LOGGER.info("Transcoded {} videos ({}), {:.1f} MB saved, {:.2f} MB/s per core".format(
+            stats["jobs"], stats["profile"], stats["bytes_saved"] / 2**20,
+            stats["bytes_per_second_per_core"] / 2**20))
+
+
+TRANSCODER = Transcoder()
+
+
+class Journal(object):
+    """
+    Append-only log of the finished units, one json line with the unit's node
+    per line, so an interrupted scrape can be resumed from the last unit.
+    """
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.nodes = {}
+        if resume is True and if_file_exists(path):
+            self.nodes = self.read()
+            self.file = open(path, "a")
+        else:
+            self.file = open(path, "w")
+
+    @staticmethod
+    def key(subject, topic, index, unit):
+        return json.dumps([subject.source_id, topic.source_id, index, unit.source_id])
+
+    def read(self):
+        return {record["key"]: record["node"]
+                for record in read_json_lines(self.path, object_hook=shared_node)}
+
+    def append(self, key, node):
+        self.nodes[key] = node
+        self.file.write(json.dumps(dict(key=key, node=node), ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+
+def shared_node(node):
+    """
+    object_hook for the nodes read back from disk: the keys, the license and the
+    values repeated in every node are shared instead of copied for each node.
+    """
+    node = {sys.intern(key): value for key, value in node.items()}
+    if node.get("license") == LICENSE:
+        node["license"] = LICENSE
+    for key in SHARED_VALUES:
+        if isinstance(node.get(key), str):
+            node[key] = sys.intern(node[key])
+    return node
+
+
+class JsonNode(object):
+    """A node already built, e.g. read back from the journal."""
+    __slots__ = ("node",)
+
+    def __init__(self, node):
+        self.node = node
+
+    def to_node(self):
+        return self.node
 
 
 class Node(object):
+    #there is an object per unit and per video, no __dict__ for them
+    __slots__ = ("title", "source_id", "tree_nodes", "lang", "description", "scope")
+
     def __init__(self, title, source_id, lang="en"):
         self.title = title
         self.source_id = source_id
         self.tree_nodes = OrderedDict()
         self.lang = lang
         self.description = None
+        self.scope = None
 
     def add_node(self, obj):
         node = obj.to_node()
         if node is not None:
             self.tree_nodes[node["source_id"]] = node
 
+    def clear(self):
+        """Removes the added nodes."""
+        self.tree_nodes = OrderedDict()
+
+    def is_named(self, names):
+        return self.title in names or self.source_id in names
+
     def to_node(self):
         return dict(
             kind=content_kinds.TOPIC,
@@ -162,49 +1521,88 @@ class Node(object):
     
 
 class Subject(Node):
-    def __init__(self, *args, **kwargs):
+    __slots__ = ("topics", "channel")
+
+    def __init__(self, *args, channel=None, **kwargs):
         super(Subject, self).__init__(*args, **kwargs)
         self.topics = []
+        self.channel = channel
+        self.scope = self.title
+
+    @property
+    def playlist_ids(self):
+        return {playlist_id for topic in self.topics for playlist_id in topic.playlist_ids}
+
+    def select(self, topic_names=None):
+        """Keeps only the topics whose title or source_id is in `topic_names`."""
+        if topic_names is not None:
+            self.topics = [topic for topic in self.topics if topic.is_named(topic_names)]
 
+    @timed("Subject.load")
     def load(self, filename, auto_parse=False):
+        """
+        Reads the topics and their playlists, the playlists are listed
+        later by Topic.load_units.
+        """
         with open(filename, "r") as f:
             topics = json.load(f)
             for topic in topics:
                 topic_obj = Topic(topic["title"], topic["source_id"], lang=CHANNEL_LANGUAGE)
-                for unit in topic["units"]:
-                    units = Topic.auto_generate_units(unit["source_id"], 
-                        title=unit["title"], lang=unit["lang"], 
-                        auto_parse=auto_parse, only_folder_name=unit.get("only", None))
-                    topic_obj.units.extend(units)
+                topic_obj.sources = topic["units"]
+                topic_obj.auto_parse = auto_parse
+                topic_obj.channel = self.channel
+                topic_obj.scope = "{} / {}".format(self.title, topic_obj.title)
                 self.topics.append(topic_obj)
 
 
 class Topic(Node):
+    __slots__ = ("units", "sources", "auto_parse", "channel")
+
     def __init__(self, *args, **kwargs):
         super(Topic, self).__init__(*args, **kwargs)
         self.units = []
+        self.sources = []
+        self.auto_parse = False
+        self.channel = None
+
+    @property
+    def playlist_ids(self):
+        return {PlaylistRegistry.playlist_id(source["source_id"]) for source in self.sources}
+
+    def load_units(self, playlists=None):
+        for source in self.sources:
+            units = Topic.auto_generate_units(source["source_id"], self.channel.playlists_dir,
+                title=source["title"], lang=source["lang"],
+                auto_parse=self.auto_parse, only_folder_name=source.get("only", None),
+                playlists=playlists)
+            for unit in units:
+                unit.scope = self.scope
+                self.units.append(unit)
 
     @staticmethod
-    def auto_generate_units(url, title=None, lang="en", auto_parse=False, only_folder_name=None):
-        youtube = YouTubeResource(url)
+    def auto_generate_units(url, directory, title=None, lang="en", auto_parse=False,
+            only_folder_name=None, playlists=None):
+        if playlists is None:
+            playlists = PLAYLISTS
+        name_links = playlists.name_links(url, directory)
         units = defaultdict(list)
         if title is not None:
             if only_folder_name is not None:
-                for subtitle, url in youtube.playlist_name_links():
+                for subtitle, url in name_links:
                     if subtitle.startswith(only_folder_name):
                         units[title].append((1, url))
             else:
-                for _, url in youtube.playlist_name_links():
+                for _, url in name_links:
                     units[title].append((1, url))
         else:
-            for name, url in youtube.playlist_name_links():
+            for name, url in name_links:
                 unit_name_list = name.split("|")
                 if len(unit_name_list) > 1 and auto_parse is False:
                     unit = unit_name_list[1]
                     unit_name = unit.strip().split(" ")[0]
                     number_unit = 1
                 else:
-                    unit_name, number_unit = title_patterns(name)
+                    unit_name, number_unit, _ = parse_title(name)
                 units[unit_name].append((number_unit, url))
 
         units = sorted(units.items(), key=lambda x: x[1][0], reverse=False)
@@ -215,17 +1613,90 @@ class Topic(Node):
 
 
 class Unit(Node):
+    __slots__ = ("urls", "resources", "downloads", "transcodes")
+
     def __init__(self, *args, **kwargs):
         super(Unit, self).__init__(*args, **kwargs)
         self.urls = []
-
-    def download(self, download=True, base_path=None):
+        self.resources = []
+        self.downloads = []
+        self.transcodes = []
+
+    def submit(self, executor, download=True, base_path=None, previous=None):
+        """
+        Queues the downloads of the unit's videos, the videos found in `previous`
+        (source_id -> node) reuse that node instead.
+        """
+        self.resources = []
+        self.downloads = []
         for url in self.urls:
-            youtube = YouTubeResource(url, lang=self.lang)
-            youtube.download(download, base_path)
-            youtube.title = remove_special_case(remove_units_number(youtube.title))
+            if previous is not None and url in previous:
+                self.resources.append(JsonNode(previous[url]))
+                self.downloads.append(None)
+            else:
+                youtube = YouTubeResource(url, lang=self.lang)
+                youtube.scope = self.scope
+                self.resources.append(youtube)
+                self.downloads.append(VIDEOS.submit(youtube, executor, download, base_path,
+                                    duration=PLAYLISTS.cache.durations.get(url)))
+
+    def transcode(self, transcoder):
+        """
+        Waits for the downloads and queues the transcoding of the downloaded
+        videos, collect then waits for it.
+        """
+        self.transcodes = []
+        for youtube, future in zip(self.resources, self.downloads):
+            if future is not None and future.exception() is None and youtube.filepath is not None:
+                self.transcodes.append(transcoder.submit(youtube))
+            else:
+                self.transcodes.append(None)
+
+    def collect(self):
+        """
+        Waits for the downloads and builds the unit, returns the videos
+        that failed with an error worth retrying at the end of the run.
+        """
+        transcodes = self.transcodes or [None] * len(self.downloads)
+        for youtube, future, transcode in zip(self.resources, self.downloads, transcodes):
+            if future is None:
+                continue
+            try:
+                future.result()
+            except Exception as e:
+                LOGGER.info("    + Download failed {}: {}".format(youtube.source_id, e))
+                youtube.filepath = None
+                continue
+            if transcode is not None:
+                #a failed transcoding leaves the downloaded file
+                transcode.result()
+            Unit.clean_title(youtube)
+        self.downloads = []
+        self.transcodes = []
+        self.build()
+        retries = [youtube for youtube in self.resources
+                    if isinstance(youtube, YouTubeResource) and youtube.retryable]
+        #the node is built, the resources are needed again only to retry
+        if len(retries) == 0:
+            self.resources = []
+        return retries
+
+    def build(self):
+        #the nodes are added in the urls order, whatever order the downloads finish
+        self.clear()
+        for youtube in self.resources:
             self.add_node(youtube)
 
+    @staticmethod
+    def clean_title(youtube):
+        if youtube.title is not None:
+            youtube.title = clean_video_title(youtube.title)
+
+    def download(self, download=True, base_path=None):
+        with DownloadScheduler(workers=1) as executor:
+            self.submit(executor, download=download, base_path=base_path)
+            self.collect()
+
     def to_node(self):
         children = list(self.tree_nodes.values())
         if len(children) == 1:
@@ -243,7 +1714,100 @@ class Unit(Node):
             )
 
 
+class VideoRegistry(object):
+    """
+    Extractions and downloads of the videos done in this run, keyed by the video
+    id, so a video referenced by several units (duplicated topics, playlists
+    shared by topics) is extracted and downloaded only once. A call in progress
+    is waited for, not repeated. A result that `keep` rejects is shared with the
+    calls waiting for it, the next call is done again.
+    """
+    def __init__(self):
+        self.calls = {}
+        #video id -> (YouTubeResource, Future) of the download queued first
+        self.downloads = {}
+        self.counts = defaultdict(Counter)
+        self.lock = threading.Lock()
+
+    def submit(self, youtube, executor, *args, **kwargs):
+        """
+        Queues youtube.download(*args, **kwargs) on `executor`, returns its Future.
+        A video already queued in this run is not queued again: the Future of its
+        download is shared, and the file, info and error are copied to `youtube`.
+        A download that failed with an error worth retrying is queued again.
+        """
+        key = youtube.video_id or youtube.source_id
+        with self.lock:
+            call = self.downloads.get(key)
+            if call is not None:
+                original, future = call
+                if future.done() and (future.exception() is not None or original.retryable):
+                    call = None
+            if call is None:
+                self.counts["downloads"]["calls"] += 1
+                future = executor.submit(youtube.download, *args, **kwargs)
+                self.downloads[key] = (youtube, future)
+                return future
+            self.counts["downloads"]["collapsed"] += 1
+
+        shared = Future()
+
+        def share(future):
+            try:
+                future.result()
+            except Exception as e:
+                shared.set_exception(e)
+            else:
+                youtube.share(original)
+                #the bytes were downloaded by the first one
+                shared.set_result(0)
+        future.add_done_callback(share)
+        return shared
+
+    def run(self, kind, key, func, keep=None):
+        """Returns the result of func() and whether it's the one of another call."""
+        with self.lock:
+            call = self.calls.get((kind, key))
+            shared = call is not None
+            if shared:
+                self.counts[kind]["collapsed"] += 1
+            else:
+                self.counts[kind]["calls"] += 1
+                call = self.calls[(kind, key)] = Future()
+        if shared:
+            return call.result(), True
+
+        try:
+            result = func()
+        except Exception as e:
+            with self.lock:
+                del self.calls[(kind, key)]
+            call.set_exception(e)
+            raise
+        if keep is not None and not keep(result):
+            with self.lock:
+                del self.calls[(kind, key)]
+        call.set_result(result)
+        return result, False
+
+    def stats(self):
+        with self.lock:
+            return {kind: dict(counts) for kind, counts in self.counts.items()}
+
+    def log_stats(self):
+        stats = self.stats()
+        LOGGER.info("Videos: {}".format(", ".join(
+            "{} {}, {} collapsed".format(counts.get("calls", 0), kind, counts.get("collapsed", 0))
+            for kind, counts in sorted(stats.items()))))
+
+
+VIDEOS = VideoRegistry()
+
+
 class YouTubeResource(object):
+    __slots__ = ("filename", "type_name", "filepath", "name", "section_title", "source_id",
+                "file_format", "lang", "is_valid", "info", "error", "scope")
+
     def __init__(self, source_id, name=None, type_name="Youtube", lang="ar", 
             embeded=False, section_title=None):
         LOGGER.info("    + Resource Type: {}".format(type_name))
@@ -260,6 +1824,9 @@ class YouTubeResource(object):
         self.file_format = file_formats.MP4
         self.lang = lang
         self.is_valid = False
+        self.info = None
+        self.error = None
+        self.scope = None
 
     def clean_url(self, url):
         if url[-1] == "/":
@@ -284,55 +1851,87 @@ class YouTubeResource(object):
             youtube = youtube and url.find("user") == -1 and url.find("/c/") == -1
         return youtube
 
+    @property
+    def video_id(self):
+        return parse_qs(urlparse(self.source_id).query).get("v", [None])[0]
+
     @classmethod
     def transform_embed(self, url):
         url = "".join(url.split("?")[:1])
         return url.replace("embed/", "watch?v=").strip()
 
-    def playlist_links(self):
+    @classmethod
+    def video_url(self, video_id):
+        return "https://www.youtube.com/watch?v={}".format(video_id)
+
+    def playlist_entries(self, policy=RETRY_POLICY):
+        """
+        List the playlist with a single flat extraction, the videos themselves
+        are not resolved. Returns dicts with title, url, id and duration. The
+        extraction is retried as the downloads are, [] if it keeps failing.
+        """
         ydl_options = {
                 'no_warnings': True,
                 'restrictfilenames':True,
-                'continuedl': True,
                 'quiet': False,
-                'format': "bestvideo[height<={maxheight}][ext=mp4]+bestaudio[ext=m4a]/best[height<={maxheight}][ext=mp4]".format(maxheight='480'),
+                'extract_flat': 'in_playlist',
                 'noplaylist': False
             }
 
-        playlist_videos_url = []
-        with youtube_dl.YoutubeDL(ydl_options) as ydl:
+        for attempt in range(policy.attempts):
+            policy.breaker.wait()
             try:
-                ydl.add_default_info_extractors()
-                info = ydl.extract_info(self.source_id, download=False)
-                for entry in info["entries"]:
-                    playlist_videos_url.append(entry["webpage_url"])
+                info = BACKEND.playlist(self.source_id, ydl_options)
             except(youtube_dl.utils.DownloadError, youtube_dl.utils.ContentTooShortError,
                     youtube_dl.utils.ExtractorError) as e:
+                error = policy.classify(e)
                 LOGGER.info('An error occured ' + str(e))
                 LOGGER.info(self.source_id)
-            except KeyError as e:
-                LOGGER.info(str(e))
-        return playlist_videos_url
+                if error == RetryPolicy.PERMANENT or not policy.backoff(error, attempt):
+                    return []
+                METRICS.add("playlist_name_links", retries=1)
+            else:
+                policy.breaker.reset()
+                break
+
+        entries = []
+        try:
+            for entry in info["entries"]:
+                if entry is None:
+                    continue
+                video_id = entry.get("id", entry.get("url"))
+                entries.append(dict(
+                    title=entry.get("title"),
+                    url=entry.get("webpage_url", YouTubeResource.video_url(video_id)),
+                    id=video_id,
+                    duration=entry.get("duration")))
+        except KeyError as e:
+            LOGGER.info(str(e))
+        return entries
 
-    def playlist_name_links(self):
-        name_url = []
-        source_id_hash = hashlib.sha1(self.source_id.encode("utf-8")).hexdigest()
-        base_path = build_path([DATA_DIR, CHANNEL_SOURCE_ID])
-        videos_url_path = os.path.join(base_path, "{}.json".format(source_id_hash))
+    def playlist_links(self):
+        return [entry["url"] for entry in self.playlist_entries()]
 
-        if if_file_exists(videos_url_path) and LOAD_VIDEO_LIST is True:
-            with open(videos_url_path, "r") as f:
-                name_url = json.load(f)
-        else:
-            for url in self.playlist_links():
-                youtube = YouTubeResource(url)
-                info = youtube.get_video_info(None, False)
-                name_url.append((info["title"], url))
-            with open(videos_url_path, "w") as f:
-                json.dump(name_url, f)
+    @timed("playlist_name_links")
+    def playlist_name_links(self, durations=None):
+        """(title, url) of the videos, their durations are added to `durations`."""
+        name_url = []
+        for entry in self.playlist_entries():
+            if durations is not None and entry["duration"] is not None:
+                durations[entry["url"]] = entry["duration"]
+            title = entry["title"]
+            #the flat listing may not have the title (e.g. some private
+            #videos), only then the video is extracted
+            if not title:
+                info = YouTubeResource(entry["url"]).get_video_info(None, False)
+                if info is None:
+                    continue
+                title = info["title"]
+            name_url.append((title, entry["url"]))
         return name_url
 
-    def get_video_info(self, download_to=None, subtitles=True):
+    @timed("get_video_info")
+    def extract_info(self, download_to=None, subtitles=True, ratelimit=None):
         ydl_options = {
                 'writesubtitles': subtitles,
                 'allsubtitles': subtitles,
@@ -341,63 +1940,131 @@ class YouTubeResource(object):
                 'continuedl': True,
                 'quiet': False,
                 'format': "bestvideo[height<={maxheight}][ext=mp4]+bestaudio[ext=m4a]/best[height<={maxheight}][ext=mp4]".format(maxheight='480'),
-                'outtmpl': '{}/%(id)s'.format(download_to),
                 'noplaylist': True
             }
+        if download_to is None:
+            return BACKEND.video_info(self.source_id, ydl_options)
+        ydl_options['outtmpl'] = '{}/%(id)s'.format(download_to)
+        if ratelimit is not None:
+            ydl_options['ratelimit'] = ratelimit
+        return BACKEND.download(self.source_id, ydl_options)
 
-        with youtube_dl.YoutubeDL(ydl_options) as ydl:
-            try:
-                ydl.add_default_info_extractors()
-                info = ydl.extract_info(self.source_id, download=(download_to is not None))
-                return info
-            except(youtube_dl.utils.DownloadError, youtube_dl.utils.ContentTooShortError,
-                    youtube_dl.utils.ExtractorError) as e:
-                LOGGER.info('An error occured ' + str(e))
-                LOGGER.info(self.source_id)
-            except KeyError as e:
-                LOGGER.info(str(e))
+    def get_video_info(self, download_to=None, subtitles=True):
+        if download_to is not None or self.video_id is None:
+            return self.try_video_info(download_to, subtitles)
+        #extracted once for all the units with the same video
+        info, _ = VIDEOS.run("extractions", (self.video_id, subtitles),
+            lambda: self.try_video_info(None, subtitles), keep=lambda info: info is not None)
+        return info
+
+    def try_video_info(self, download_to=None, subtitles=True):
+        try:
+            return self.extract_info(download_to=download_to, subtitles=subtitles)
+        except(youtube_dl.utils.DownloadError, youtube_dl.utils.ContentTooShortError,
+                youtube_dl.utils.ExtractorError) as e:
+            LOGGER.info('An error occured ' + str(e))
+            LOGGER.info(self.source_id)
+        except KeyError as e:
+            LOGGER.info(str(e))
+
+    @property
+    def retryable(self):
+        return self.error in (RetryPolicy.TRANSIENT, RetryPolicy.RATE_LIMITED)
 
+    @timed("subtitles_dict")
     def subtitles_dict(self):
         subs = []
-        video_info = self.get_video_info()
+        #the info of the download step already lists the subtitles
+        video_info = self.info if self.info is not None else self.get_video_info()
         if video_info is not None:
             video_id = video_info["id"]
             if 'subtitles' in video_info:
                 subtitles_info = video_info["subtitles"]
                 for language in subtitles_info.keys():
-                    subs.append(dict(file_type=SUBTITLES_FILE, youtube_id=video_id, language=language))
+                    if not SUBTITLES.allowed(language):
+                        continue
+                    cached = SUBTITLES.get(video_id, language)
+                    if cached is not None:
+                        path, subtitles_format = cached
+                        subs.append(dict(file_type=SUBTITLES_FILE, path=path, language=language,
+                                        subtitlesformat=subtitles_format))
+                    else:
+                        subs.append(dict(file_type=SUBTITLES_FILE, youtube_id=video_id, language=language))
         return subs
 
     #youtubedl has some troubles downloading videos in youtube,
     #sometimes raises connection error
     #for that I choose pafy for downloading
-    def download(self, download=True, base_path=None):
+    @timed("YouTubeResource.download")
+    def download(self, download=True, base_path=None, policy=RETRY_POLICY, ratelimit=None):
+        """
+        Downloads the video at most `ratelimit` bytes per second (None for no limit),
+        returns the number of bytes downloaded.
+        """
         if not "watch?" in self.source_id or "/user/" in self.source_id or\
             download is False:
             return
 
         download_to = build_path([base_path, 'videos'])
-        for i in range(4):
-            try:
-                info = self.get_video_info(download_to=download_to, subtitles=False)
+        return self.fetch(download_to, policy, ratelimit)
+
+    def share(self, other):
+        """Takes the download of the same video by `other`."""
+        self.info = other.info
+        self.filepath = other.filepath
+        self.filename = other.filename
+        self.error = other.error
+
+    def fetch(self, download_to, policy, ratelimit):
+        store = VideoStore.get(download_to)
+        entry = store.check(self.video_id)
+        if entry is not None:
+            METRICS.add("YouTubeResource.download", self.scope, cache_hits=1)
+            LOGGER.info("    + Already downloaded: {}".format(entry["path"]))
+            self.info = entry["info"]
+            self.filepath = entry["path"]
+            self.filename = self.info["title"]
+            #hashed in the background if the file changed since the last run
+            HASHES.submit(self.filepath)
+            #the urls of the tracks not cached yet come from a new extraction
+            if len(SUBTITLES.missing(self.info["id"], self.info["subtitles"])) > 0:
+                info = self.get_video_info()
                 if info is not None:
-                    LOGGER.info("    + Video resolution: {}x{}".format(info.get("width", ""), info.get("height", "")))
-                    self.filepath = os.path.join(download_to, "{}.mp4".format(info["id"]))
-                    self.filename = info["title"]
-                    if self.filepath is not None and os.stat(self.filepath).st_size == 0:
-                        LOGGER.info("    + Empty file")
-                        self.filepath = None
-            except (ValueError, IOError, OSError, URLError, ConnectionResetError) as e:
-                LOGGER.info(e)
-                LOGGER.info("Download retry")
-                time.sleep(.8)
+                    SUBTITLES.fetch(info["id"], info.get("subtitles", {}))
+            return
+
+        METRICS.add("YouTubeResource.download", self.scope, cache_misses=1)
+        for attempt in range(policy.attempts):
+            policy.breaker.wait()
+            try:
+                info = self.extract_info(download_to=download_to, subtitles=False,
+                                        ratelimit=ratelimit)
             except (youtube_dl.utils.DownloadError, youtube_dl.utils.ContentTooShortError,
-                    youtube_dl.utils.ExtractorError, OSError) as e:
-                LOGGER.info("     + An error ocurred, may be the video is not available.")
-                return
-            except OSError:
-                return
+                    youtube_dl.utils.ExtractorError, ValueError, OSError) as e:
+                self.error = policy.classify(e)
+                LOGGER.info("    + {} error: {}".format(self.error, e))
+                if self.error == RetryPolicy.PERMANENT:
+                    LOGGER.info("     + An error ocurred, may be the video is not available.")
+                    return
+                if policy.backoff(self.error, attempt):
+                    METRICS.add("YouTubeResource.download", self.scope, retries=1)
             else:
+                self.error = None
+                policy.breaker.reset()
+                self.info = info
+                LOGGER.info("    + Video resolution: {}x{}".format(info.get("width", ""), info.get("height", "")))
+                self.filepath = os.path.join(download_to, "{}.mp4".format(info["id"]))
+                self.filename = info["title"]
+                if os.stat(self.filepath).st_size == 0:
+                    LOGGER.info("    + Empty file")
+                    self.filepath = None
+                else:
+                    entry = store.add(info["id"], self.filepath, info)
+                    #the subset of the info dict kept by the store is all the node needs
+                    self.info = entry["info"]
+                    SUBTITLES.fetch(info["id"], info.get("subtitles", {}))
+                    METRICS.add("YouTubeResource.download", self.scope, bytes=entry["size"])
+                    return entry["size"]
                 return
 
     def to_node(self):
@@ -417,125 +2084,380 @@ class YouTubeResource(object):
             return node
 
 
-# The chef subclass
+# Channels
 ################################################################################
-class KingKhaledChef(JsonTreeChef):
-    HOSTNAME = BASE_URL
-    TREES_DATA_DIR = os.path.join(DATA_DIR, 'trees')
-
-    def __init__(self):
-        build_path([KingKhaledChef.TREES_DATA_DIR])
-        super(KingKhaledChef, self).__init__()
-
-    def pre_run(self, args, options):
-        channel_tree = self.scrape(args, options)
-        self.write_tree_to_json(channel_tree)
-
-    def k12_lessons(self):
-        global CHANNEL_SOURCE_ID
-        self.RICECOOKER_JSON_TREE = 'ricecooker_json_tree_k12.json'
-        CHANNEL_NAME = "ELD King Khaled University Learning (العربيّة)"
-        CHANNEL_SOURCE_ID = "sushi-chef-eld-k12-ar"
-        channel_tree = dict(
+class ChannelConfig(object):
+    """
+    The metadata, the tree file and the options of one channel. The playlist
+    registry, the video store and the download workers are shared by all the
+    channels scraped in a run.
+    """
+    def __init__(self, source_id, name, description, json_tree, download_videos=True):
+        self.source_id = source_id
+        self.name = name
+        self.description = description
+        self.json_tree = json_tree
+        self.download_videos = download_videos
+        self.subjects = []
+        self.journal = None
+        self.stats = []
+        self.channel_tree = dict(
                 source_domain=KingKhaledChef.HOSTNAME,
-                source_id=CHANNEL_SOURCE_ID,
-                title=CHANNEL_NAME,
-                description="""تحتوي هذه القناة على مجموعة من الدروس في اللغة العربية والتجويد واللغة الإنجليزية والرياضيات الأساسية، وهي مجموعة من المقررات التي صممتها جامعة الملك خالد كجزء من مقرراتها الرقمية المفتوحة. وتناسب هذه الدروس طلاب المرحلة الثانوية ويمكن ملاءمتها مع بعض الصفوف للمرحلة الإعدادية أيضاً."""
-[:400], #400 UPPER LIMIT characters allowed 
+                source_id=source_id,
+                title=name,
+                description=description[:400], #400 UPPER LIMIT characters allowed 
                 thumbnail=CHANNEL_THUMBNAIL,
                 author=AUTHOR,
                 language=CHANNEL_LANGUAGE,
                 children=[],
                 license=LICENSE,
             )
-        subject_en = Subject(title="English Language Skills اللغة الإنجليزية", 
-                            source_id="English Language Skills اللغة الإنجليزية")
-        subject_en.load("resources_en_lang_skills.json")
 
-        subject_ar = Subject(title="Arabic Language Skills اللغة العربية", 
-                            source_id="Arabic Language Skills اللغة الإنجليزية")
-        subject_ar.load("resources_ar_lang_skills.json")
+    @property
+    def playlists_dir(self):
+        return os.path.join(DATA_DIR, self.source_id)
 
-        subject_ar_st = Subject(title="Islamic Studies الثقافة الإسلامية", 
-                            source_id="Islamic Studies الثقافة الإسلامية")
-        subject_ar_st.load("resources_ar_islamic_studies.json")
+    @property
+    def tree_path(self):
+        return os.path.join(KingKhaledChef.TREES_DATA_DIR, self.json_tree)
+
+    def add_subject(self, title, source_id, filename, auto_parse=False):
+        subject = Subject(title=title, source_id=source_id, channel=self)
+        subject.load(filename, auto_parse=auto_parse)
+        self.subjects.append(subject)
+
+    def add_node(self, subject):
+        """Adds the subject's node to the tree, or replaces it if it's there."""
+        node = subject.to_node()
+        children = self.channel_tree["children"]
+        for i, child in enumerate(children):
+            if child["source_id"] == node["source_id"]:
+                children[i] = node
+                break
+        else:
+            children.append(node)
 
-        subject_ar_math = Subject(title="Math الرياضيات", 
-                            source_id="Math الرياضيات")
-        subject_ar_math.load("resources_ar_math.json")
 
-        subjects = [subject_en, subject_ar, subject_ar_st, subject_ar_math]
-        return channel_tree, subjects
+# The chef subclass
+################################################################################
+class KingKhaledChef(JsonTreeChef):
+    HOSTNAME = BASE_URL
+    TREES_DATA_DIR = os.path.join(DATA_DIR, 'trees')
 
-    def intermediate_lessons(self):
-        global CHANNEL_SOURCE_ID
-        self.RICECOOKER_JSON_TREE = 'ricecooker_json_tree_professional.json'
-        CHANNEL_NAME = "ELD Teacher Professional Development Cources (العربيّة)"
-        CHANNEL_SOURCE_ID = "sushi-chef-eld-teacher-prof-dev-ar"
-        channel_tree = dict(
-                source_domain=KingKhaledChef.HOSTNAME,
-                source_id=CHANNEL_SOURCE_ID,
-                title=CHANNEL_NAME,
-                description="""تحتوي هذه القناة على مجموعة من الدورات الملائمة للمعلمين  في مجالات التربية والتعليم ومهارات تدريس اللغة العربية والإدارة المدرسية والمناهج. وهي مجموعة من المقررات التي صممتها جامعة الملك خالد كجزء من مقرراتها الرقمية المفتوحة. وتناسب هذه المحاضرات جميع المعلمين بمختلف تخصصاتهم."""
-[:400], #400 UPPER LIMIT characters allowed 
-                thumbnail=CHANNEL_THUMBNAIL,
-                author=AUTHOR,
-                language=CHANNEL_LANGUAGE,
-                children=[],
-                license=LICENSE,
-            )
+    def __init__(self):
+        build_path([KingKhaledChef.TREES_DATA_DIR])
+        super(KingKhaledChef, self).__init__()
 
-        subject_sedu = Subject(title="التربية الخاصة Special Education", 
-                            source_id="التربية الخاصة Special Education")
-        subject_sedu.load("resources_ar_special_education.json", auto_parse=True)
+    def pre_run(self, args, options):
+        channels = self.scrape(args, options)
+        #ricecooker uploads a single tree, the one of the first channel
+        self.RICECOOKER_JSON_TREE = channels[0].json_tree
+        with ThreadPoolExecutor(max_workers=len(channels)) as executor:
+            list(executor.map(self.write_tree_to_json, channels))
+        for channel in channels:
+            channel.journal.remove()
+        if len(channels) == 1:
+            report = "{}_report.json".format(os.path.splitext(channels[0].json_tree)[0])
+        else:
+            report = "ricecooker_json_tree_all_report.json"
+        METRICS.write(os.path.join(KingKhaledChef.TREES_DATA_DIR, report))
 
-        subject_about_edu = Subject(title="في التربية والتعليم About Education and Schooling",
-                                source_id="في التربية والتعليم About Education and Schooling")
-        subject_about_edu.load("resources_ar_about_education.json", auto_parse=True)
+    def k12_lessons(self):
+        channel = ChannelConfig("sushi-chef-eld-k12-ar",
+            "ELD King Khaled University Learning (العربيّة)",
+            """تحتوي هذه القناة على مجموعة من الدروس في اللغة العربية والتجويد واللغة الإنجليزية والرياضيات الأساسية، وهي مجموعة من المقررات التي صممتها جامعة الملك خالد كجزء من مقرراتها الرقمية المفتوحة. وتناسب هذه الدروس طلاب المرحلة الثانوية ويمكن ملاءمتها مع بعض الصفوف للمرحلة الإعدادية أيضاً.""",
+            'ricecooker_json_tree_k12.json')
+        channel.add_subject("English Language Skills اللغة الإنجليزية",
+                            "English Language Skills اللغة الإنجليزية",
+                            "resources_en_lang_skills.json")
+        channel.add_subject("Arabic Language Skills اللغة العربية",
+                            "Arabic Language Skills اللغة الإنجليزية",
+                            "resources_ar_lang_skills.json")
+        channel.add_subject("Islamic Studies الثقافة الإسلامية",
+                            "Islamic Studies الثقافة الإسلامية",
+                            "resources_ar_islamic_studies.json")
+        channel.add_subject("Math الرياضيات", "Math الرياضيات", "resources_ar_math.json")
+        return channel
 
-        subject_teaching = Subject(title="مناهج وتدريس Teaching and Curriculum",
-                                source_id="مناهج وتدريس Teaching and Curriculum")
-        subject_teaching.load("resources_ar_teaching.json", auto_parse=True)
-        subjects = [subject_sedu, subject_about_edu, subject_teaching]
-        return channel_tree, subjects
+    def intermediate_lessons(self):
+        channel = ChannelConfig("sushi-chef-eld-teacher-prof-dev-ar",
+            "ELD Teacher Professional Development Cources (العربيّة)",
+            """تحتوي هذه القناة على مجموعة من الدورات الملائمة للمعلمين  في مجالات التربية والتعليم ومهارات تدريس اللغة العربية والإدارة المدرسية والمناهج. وهي مجموعة من المقررات التي صممتها جامعة الملك خالد كجزء من مقرراتها الرقمية المفتوحة. وتناسب هذه المحاضرات جميع المعلمين بمختلف تخصصاتهم.""",
+            'ricecooker_json_tree_professional.json')
+        channel.add_subject("التربية الخاصة Special Education",
+                            "التربية الخاصة Special Education",
+                            "resources_ar_special_education.json", auto_parse=True)
+        channel.add_subject("في التربية والتعليم About Education and Schooling",
+                            "في التربية والتعليم About Education and Schooling",
+                            "resources_ar_about_education.json", auto_parse=True)
+        channel.add_subject("مناهج وتدريس Teaching and Curriculum",
+                            "مناهج وتدريس Teaching and Curriculum",
+                            "resources_ar_teaching.json", auto_parse=True)
+        return channel
 
     def scrape(self, args, options):
+        """Scrapes the selected channels, returns their ChannelConfig."""
         download_video = options.get('--download-video', "1")
         basic_lessons = int(options.get('--basic-lessons', "0"))
         intermedian_lessons = int(options.get('--intermedian-lessons', "0"))
+        all_channels = int(options.get('--all-channels', "0")) == 1
         load_video_list = options.get('--load-video-list', "0")
-
-        if int(download_video) == 0:
-            global DOWNLOAD_VIDEOS
-            DOWNLOAD_VIDEOS = False
-
-        if int(load_video_list) == 1:
-            global LOAD_VIDEO_LIST
-            LOAD_VIDEO_LIST = True
-
-        global channel_tree
-        if basic_lessons == 1:
-            channel_tree, subjects = self.k12_lessons()
+        workers = int(options.get('--workers', "1"))
+        resume = int(options.get('--resume', "0")) == 1
+        queue_size = int(options.get('--queue-size', "8"))
+        incremental = int(options.get('--incremental', "0")) == 1
+
+        RETRY_POLICY.attempts = int(options.get('--retries', RETRY_POLICY.attempts))
+        RETRY_POLICY.breaker.cooldown = int(options.get('--throttle-pause',
+                                        RETRY_POLICY.breaker.cooldown))
+        cache.max_bytes = int(options.get('--http-cache-mb', cache.max_bytes // 2**20)) * 2**20
+        cache.max_age = float(options.get('--http-cache-days', cache.max_age / 86400)) * 86400
+        PLAYLISTS.resolver.concurrency = int(options.get('--resolve-concurrency',
+                                        PLAYLISTS.resolver.concurrency))
+        PLAYLISTS.resolver.rate = float(options.get('--rate-limit', 0)) or None
+        PLAYLISTS.cache.ttl = int(options.get('--playlist-ttl', PLAYLISTS.cache.ttl))
+        PLAYLISTS.cache.stale = int(options.get('--playlist-stale', PLAYLISTS.cache.stale))
+        PLAYLISTS.cache.max_orphans = int(options.get('--playlist-cache-size',
+                                        PLAYLISTS.cache.max_orphans))
+        #resuming, the units must come out as in the interrupted run
+        if int(load_video_list) == 1 or resume is True:
+            PLAYLISTS.cache.ttl = float("inf")
+        #the tree of the interrupted or previous run was built from the saved listings
+        if resume is True or incremental is True:
+            PLAYLISTS.cache.promote = False
+        #the playlists must be listed again to find what changed
+        if incremental is True:
+            PLAYLISTS.cache.ttl = 0
+            PLAYLISTS.cache.stale = 0
+
+        if all_channels is True:
+            channels = [self.k12_lessons(), self.intermediate_lessons()]
+        elif basic_lessons == 1:
+            channels = [self.k12_lessons()]
         elif intermedian_lessons == 1:
-            channel_tree, subjects = self.intermediate_lessons()
+            channels = [self.intermediate_lessons()]
+
+        #no playlist is listed yet, the filtered out subtrees cost nothing
+        only_subject = options.get('--only-subject')
+        only_topic = options.get('--only-topic')
+        for channel in channels:
+            channel.download_videos = int(download_video) != 0
+            if only_subject is not None:
+                channel.subjects = [subject for subject in channel.subjects
+                                    if subject.is_named(only_subject.split(","))]
+            if only_topic is not None:
+                for subject in channel.subjects:
+                    subject.select(only_topic.split(","))
+                channel.subjects = [subject for subject in channel.subjects
+                                    if len(subject.topics) > 0]
 
         base_path = [DATA_DIR] + ["King Khaled University in Abha"]
         base_path = build_path(base_path)
 
-        for subject in subjects:
+        subtitle_languages = options.get('--subtitle-languages')
+        SUBTITLES.open(build_path([base_path, "subtitles"]),
+            languages=subtitle_languages.split(",") if subtitle_languages is not None else None,
+            workers=int(options.get('--subtitle-workers', "4")))
+        #the videos of the previous runs are hashed in the background, the unchanged
+        #ones only once ever
+        HASHES.open(base_path, workers=int(options.get('--hash-workers', "0")))
+        videos = VideoStore.get(build_path([base_path, "videos"])).videos
+        threading.Thread(target=HASHES.update, daemon=True,
+            args=([entry["path"] for entry in videos.values()],)).start()
+        if options.get('--transcode') is not None:
+            TRANSCODER.open(build_path([base_path, "transcoded"]), options['--transcode'],
+                workers=int(options.get('--transcode-workers', "0")))
+
+        #the playlists are listed in the background, the resolve stage waits
+        #only for the one it needs
+        sources = [(source["source_id"], channel.playlists_dir) for channel in channels
+                    for subject in channel.subjects for topic in subject.topics
+                    for source in topic.sources]
+        threading.Thread(target=PLAYLISTS.prefetch, args=(sources,), daemon=True).start()
+
+        bandwidth_limit = float(options.get('--bandwidth-limit', "0"))
+        max_download_mb = int(options.get('--max-download-mb', "0"))
+        scheduler = DownloadScheduler(workers=workers,
+            bandwidth=bandwidth_limit * 2**20 or None,
+            max_bytes=max_download_mb * 2**20 or None,
+            bitrate=int(options.get('--video-kbps', "500")) * 1000 // 8)
+
+        #the channels are scraped side by side and share the download workers
+        with scheduler as executor:
+            with ThreadPoolExecutor(max_workers=len(channels)) as channel_executor:
+                list(channel_executor.map(
+                    lambda channel: self.scrape_channel(channel, executor, base_path,
+                                        queue_size=queue_size, resume=resume,
+                                        incremental=incremental),
+                    channels))
+        VideoStore.close_all()
+
+        METRICS.extra["pipeline"] = {channel.source_id: [vars(stats) for stats in channel.stats]
+                                    for channel in channels}
+        METRICS.extra["backend"] = BACKEND.stats()
+        METRICS.extra["downloads"] = scheduler.stats()
+        scheduler.log_stats()
+        METRICS.extra["videos"] = VIDEOS.stats()
+        VIDEOS.log_stats()
+        METRICS.extra["http_cache"] = cache.stats()
+        cache.log_stats()
+        METRICS.extra["hashes"] = HASHES.stats()
+        HASHES.log_stats()
+        if TRANSCODER.enabled:
+            METRICS.extra["transcode"] = TRANSCODER.stats()
+            TRANSCODER.log_stats()
+        PLAYLISTS.cache.close()
+        PLAYLISTS.cache.evict()
+        PLAYLISTS.log_stats()
+        return channels
+
+    def scrape_channel(self, channel, executor, base_path, queue_size=8, resume=False,
+            incremental=False):
+        """Builds channel.channel_tree, the videos are downloaded by `executor`."""
+        previous_tree = self.previous_videos(channel) if incremental is True else None
+
+        channel.journal = Journal("{}.journal".format(channel.tree_path), resume=resume)
+        if len(channel.journal.nodes) > 0:
+            LOGGER.info("Resuming {}, {} units already done".format(
+                channel.name, len(channel.journal.nodes)))
+
+        def enumerate_topics(subject):
+            for topic in subject.topics:
+                yield subject, topic, None, None
+            yield subject, None, None, None
+
+        def resolve(item):
+            subject, topic, _, _ = item
+            if topic is not None:
+                topic.load_units()
+                for i, unit in enumerate(topic.units):
+                    yield subject, topic, i, unit
+            yield item
+
+        def download(item):
+            subject, topic, i, unit = item
+            if unit is not None and Journal.key(subject, topic, i, unit) not in channel.journal.nodes:
+                if previous_tree is not None:
+                    _, _, unchanged = PLAYLISTS.diff(topic.playlist_ids)
+                    previous = {}
+                    for url in unchanged:
+                        node = previous_tree.get(url, kind=content_kinds.VIDEO)
+                        if node is not None:
+                            previous[url] = node
+                else:
+                    previous = None
+                unit.submit(executor, download=channel.download_videos, base_path=base_path,
+                            previous=previous)
+            yield item
+
+        def transcode(item):
+            subject, topic, i, unit = item
+            if unit is not None and len(unit.downloads) > 0:
+                unit.transcode(TRANSCODER)
+            yield item
+
+        def build_node(item):
+            subject, topic, i, unit = item
+            if topic is None:
+                if previous_tree is not None:
+                    added, removed, unchanged = PLAYLISTS.diff(subject.playlist_ids)
+                    #the videos that failed in the previous run are not in its tree
+                    missing = {url for url in unchanged
+                                if previous_tree.get(url, kind=content_kinds.VIDEO) is None}
+                    LOGGER.info("{}: {} added, {} removed, {} unchanged videos".format(
+                        subject.title, len(added | missing), len(removed),
+                        len(unchanged - missing)))
+                channel.add_node(subject)
+            elif unit is None:
+                subject.add_node(topic)
+            else:
+                key = Journal.key(subject, topic, i, unit)
+                if key in channel.journal.nodes:
+                    node = channel.journal.nodes[key]
+                else:
+                    for youtube in unit.collect():
+                        retries.append((subject, topic, i, unit, youtube))
+                    node = unit.to_node()
+                    channel.journal.append(key, node)
+                topic.add_node(JsonNode(node))
+
+        retries = []
+        pipeline = Pipeline(maxsize=queue_size)
+        items = pipeline.stage("enumerate", enumerate_topics, channel.subjects)
+        items = pipeline.stage("resolve", resolve, items)
+        items = pipeline.stage("download", download, items)
+        if TRANSCODER.enabled:
+            items = pipeline.stage("transcode", transcode, items)
+        pipeline.consume("node", build_node, items)
+        self.drain_retries(executor, retries, channel, base_path)
+
+        LOGGER.info("Pipeline of {}".format(channel.name))
+        pipeline.log_stats()
+        channel.stats = pipeline.stats
+
+    def drain_retries(self, executor, retries, channel, base_path):
+        """
+        Downloads once more the videos that failed with a transient or rate-limited
+        error, and rebuilds the subjects where some of them succeeded.
+        """
+        if len(retries) == 0:
+            return
+        LOGGER.info("Retrying {} videos".format(len(retries)))
+        downloads = [VIDEOS.submit(youtube, executor, channel.download_videos, base_path,
+                        duration=PLAYLISTS.cache.durations.get(youtube.source_id))
+                    for _, _, _, _, youtube in retries]
+        recovered = OrderedDict()
+        transcodes = []
+        for (subject, topic, i, unit, youtube), future in zip(retries, downloads):
+            try:
+                future.result()
+            except Exception as e:
+                LOGGER.info("    + Download failed {}: {}".format(youtube.source_id, e))
+                continue
+            if youtube.filepath is not None:
+                if TRANSCODER.enabled:
+                    transcodes.append(TRANSCODER.submit(youtube))
+                Unit.clean_title(youtube)
+                recovered[(subject.source_id, topic.source_id, i)] = (subject, topic, i, unit)
+        for transcode in transcodes:
+            transcode.result()
+        LOGGER.info("{} of {} videos recovered".format(len(recovered), len(retries)))
+
+        for subject, topic, i, unit in recovered.values():
+            unit.build()
+            channel.journal.append(Journal.key(subject, topic, i, unit), unit.to_node())
+        for subject in {subject for subject, _, _, _ in recovered.values()}:
             for topic in subject.topics:
-                for unit in topic.units:
-                    unit.download(download=DOWNLOAD_VIDEOS, base_path=base_path)
-                    topic.add_node(unit)
+                topic.clear()
+                for i, unit in enumerate(topic.units):
+                    topic.add_node(JsonNode(
+                        channel.journal.nodes[Journal.key(subject, topic, i, unit)]))
                 subject.add_node(topic)
-            channel_tree["children"].append(subject.to_node())
-        
-        return channel_tree
-
-    def write_tree_to_json(self, channel_tree):
-        scrape_stage = os.path.join(KingKhaledChef.TREES_DATA_DIR, 
-                                self.RICECOOKER_JSON_TREE)
-        write_tree_to_json_tree(scrape_stage, channel_tree)
+            channel.add_node(subject)
+
+    def previous_videos(self, channel):
+        """TreeIndex of the last written tree of the channel."""
+        if not if_file_exists(channel.tree_path):
+            LOGGER.info("No previous tree, the whole channel is scraped")
+            return None
+
+        with open(channel.tree_path, "r") as f:
+            previous_tree = json.load(f, object_hook=shared_node)
+        return TreeIndex(previous_tree)
+
+    @timed("write_tree_to_json")
+    def write_tree_to_json(self, channel):
+        """
+        Streams the tree to the file chunk by chunk, the json text of the whole
+        tree is never held in memory. The file is replaced in one step, an
+        interrupted write leaves the previous tree for --incremental.
+        """
+        encoder = json.JSONEncoder(indent=2, ensure_ascii=False)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", buffering=1048576,
+                dir=os.path.dirname(channel.tree_path), delete=False, suffix=".tmp") as f:
+            for chunk in encoder.iterencode(channel.channel_tree):
+                f.write(chunk)
+        os.replace(f.name, channel.tree_path)
 
 
 # CLI
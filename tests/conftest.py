@@ -0,0 +1,41 @@
+import os
+import sys
+from collections import Counter
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helpers import FakeBackend
+import sushichef
+
+
+PLAYLIST_URL = "https://www.youtube.com/playlist?list=PLfake0001"
+
+
+class CountingBackend(FakeBackend):
+    """FakeBackend that also counts its calls per video (or playlist) id."""
+    def __init__(self, *args, **kwargs):
+        super(CountingBackend, self).__init__(*args, **kwargs)
+        self.per_id = Counter()
+
+    def call(self, name, key):
+        with self.lock:
+            self.per_id[(name, key)] += 1
+        super(CountingBackend, self).call(name, key)
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    """
+    A fake youtube_dl backend and fresh run-wide registries, the chef writes
+    in tmp_path.
+    """
+    monkeypatch.chdir(tmp_path)
+    backend = CountingBackend(videos=6)
+    monkeypatch.setattr(sushichef, "BACKEND", backend)
+    monkeypatch.setattr(sushichef, "VIDEOS", sushichef.VideoRegistry())
+    monkeypatch.setattr(sushichef, "PLAYLISTS",
+                        sushichef.PlaylistRegistry(sushichef.PlaylistCache()))
+    monkeypatch.setattr(sushichef.RETRY_POLICY, "base_delay", 0)
+    return backend
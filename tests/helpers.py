@@ -0,0 +1,240 @@
+"""
+Helpers of the tests that benchmark.py uses too: a fake youtube_dl backend,
+the title chain replaced by sushichef.parse_title, the titles of the saved
+playlist listings and a local http server with byte ranges.
+"""
+from collections import Counter
+import glob
+import hashlib
+import http.server
+import json
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+import youtube_dl
+
+from sushichef import PlaylistRegistry, YoutubeDLBackend
+from utils import if_file_exists
+
+
+class FakeBackend(YoutubeDLBackend):
+    """
+    Deterministic stand-in for youtube_dl to test and benchmark the chef without
+    network, set as sushichef.BACKEND. Every playlist has `videos` synthetic
+    entries, the downloads are small mp4 files of `size` bytes, each call waits
+    `latency` seconds and fails with a transient error with probability
+    `failure_rate`.
+    """
+    TOPICS = ("Grammar", "Writing", "Reading", "Listening")
+    MP4_HEADER = b"\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom"
+
+    def __init__(self, videos=10, latency=0., failure_rate=0., size=65536, seed=0):
+        super(FakeBackend, self).__init__()
+        self.videos = videos
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.size = size
+        self.seed = seed
+        self.attempts = Counter()
+
+    def call(self, name, key):
+        self.count(name)
+        time.sleep(self.latency)
+        with self.lock:
+            self.attempts[key] += 1
+            attempt = self.attempts[key]
+        #the same call fails the same way on every run
+        if random.Random("{}:{}:{}".format(self.seed, key, attempt)).random() < self.failure_rate:
+            raise youtube_dl.utils.DownloadError("ERROR: fake failure, HTTP Error 503")
+
+    def title(self, index):
+        return "{} - الوحدة {} - درس {}".format(
+            FakeBackend.TOPICS[index % len(FakeBackend.TOPICS)], index // 4 + 1, index + 1)
+
+    def playlist(self, url, ydl_options):
+        playlist_id = PlaylistRegistry.playlist_id(url)
+        self.call("playlists", playlist_id)
+        prefix = hashlib.sha1(playlist_id.encode("utf-8")).hexdigest()[:8]
+        entries = []
+        for index in range(self.videos):
+            video_id = "{}{:03d}".format(prefix, index)
+            entries.append(dict(_type="url", ie_key="Youtube", id=video_id, url=video_id,
+                                title=self.title(index), duration=60 + index))
+        return dict(_type="playlist", id=playlist_id, entries=entries)
+
+    def video_info(self, url, ydl_options):
+        video_id = parse_qs(urlparse(url).query)["v"][0]
+        self.call("videos", video_id)
+        return dict(id=video_id, title=self.title(int(video_id[-3:])), webpage_url=url,
+                    width=854, height=480, format_id="fake", filesize=self.size,
+                    duration=60 + int(video_id[-3:]),
+                    subtitles={language: [dict(ext="vtt", url="https://fake.subtitles/{}/{}.vtt".format(
+                                video_id, language))] for language in ("ar", "en", "fr")})
+
+    def download(self, url, ydl_options):
+        info = self.video_info(url, ydl_options)
+        self.call("downloads", info["id"])
+        if ydl_options.get("ratelimit"):
+            time.sleep(self.size / ydl_options["ratelimit"])
+        filepath = "{}.mp4".format(ydl_options["outtmpl"].replace("%(id)s", info["id"]))
+        if not if_file_exists(filepath):
+            with open(filepath, "wb") as f:
+                f.write(FakeBackend.MP4_HEADER)
+                f.write(b"\x00" * (self.size - len(FakeBackend.MP4_HEADER)))
+        return info
+
+    def subtitle(self, url):
+        self.call("subtitles", url)
+        return "WEBVTT\n\n00:00.000 --> 00:01.000\n{}\n".format(url).encode("utf-8")
+
+
+def old_title_has_numeration(title):
+    """title_has_numeration of the title chain replaced by sushichef.parse_title."""
+    unit_name_ar = ["الوحده", "الوحدة"]
+    for unit_name in unit_name_ar:
+        if unit_name in title:
+            index = title.find(unit_name)
+            match = re.search(r"(?P<int>\d+)", title)
+            if match:
+                num = int(match.group("int"))
+                return title[index: index+len(unit_name)] + " " + str(num), num
+            else:
+                return title[index: index+len(unit_name)], None
+
+    numbers = list(map(str, [1,2,3,4,5,6,7,8,9]))
+    title = title.replace("-", " ")
+    for elem in title.split(" "):
+        elem = elem.strip()
+        for num in numbers:
+            if elem == num:
+                return title.replace(elem, "").strip(), int(num)
+
+    for arab_num in title:
+        index = title.find(arab_num)
+        if index != -1 and index >= len(title) - 1:
+            return title.replace(arab_num, "").strip(), 1
+
+    return False, None
+
+
+def old_title_patterns(title):
+    title = re.sub(' +', ' ' , title)
+    pattern01 = r"\d+\-\d+"
+    match = re.search(pattern01, title)
+    if match:
+        index = match.span()
+        numbers = title[index[0]:index[1]]
+        number_unit = numbers.split("-")[0].strip()
+        return "Unit {}".format(number_unit), int(number_unit)
+
+    pattern02 = r"\d+\s+\d+"
+    match = re.search(pattern02, title)
+    if match:
+        #the original referenced an undefined `number` here and raised NameError
+        raise NameError("name 'number' is not defined")
+
+    title_unit, unit_num = old_title_has_numeration(title)
+    if title_unit is not False and unit_num is not None:
+        return title_unit, unit_num
+    elif title_unit is not False and unit_num is None:
+        return title_unit, 1
+    else:
+        return title, 1
+
+
+def old_clean_title(title):
+    """remove_units_number then remove_special_case."""
+    match = re.search(r'\|.*\|', title)
+    if match:
+        index = match.span()
+        title = "{} | {}".format(title[:index[0]].strip(), title[index[1]:].strip()).strip()
+    title = title.replace("مهارات في علم الرياضيات", "")
+    title = title.replace("-", "")
+    return title.strip()
+
+
+def old_parse_title(title):
+    return old_title_patterns(title) + (old_clean_title(title),)
+
+
+def changed_title(title):
+    """The titles the old chain parses differently on purpose."""
+    return re.search(r"\d\s+\d", title) is not None or\
+        re.search("[٠-٩]", title) is not None
+
+
+def saved_titles(directory):
+    """
+    The video titles of the playlist listings saved by the chef in
+    <directory>/<channel source id>/, in the order they are listed.
+    """
+    titles = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*", "*.json"))):
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            continue
+        #the trees and the reports are in the same layout
+        if isinstance(entry, dict) and "fetched_at" in entry:
+            titles.update((title, None) for title, _ in entry["videos"])
+    return list(titles)
+
+
+def range_server(directory, rate=None):
+    """
+    Local http server of `directory` with byte ranges, each connection sends at
+    most `rate` bytes per second. Once `server.budget` bytes are sent (None for
+    no limit) the connections are cut.
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            path = os.path.join(directory, self.path.lstrip("/").split("?")[0])
+            size = os.path.getsize(path)
+            start, end = 0, size - 1
+            match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if match is not None:
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            with open(path, "rb") as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = f.read(min(65536, remaining))
+                    with server.lock:
+                        if server.budget is not None:
+                            if server.budget <= 0:
+                                self.close_connection = True
+                                return
+                            server.budget -= len(chunk)
+                        server.sent += len(chunk)
+                    try:
+                        self.wfile.write(chunk)
+                    except (BrokenPipeError, ConnectionResetError):
+                        return
+                    remaining -= len(chunk)
+                    if rate:
+                        time.sleep(len(chunk) / rate)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.budget = None
+    server.sent = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
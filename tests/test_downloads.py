@@ -0,0 +1,275 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+
+import pytest
+
+from conftest import PLAYLIST_URL
+import sushichef
+from sushichef import DownloadScheduler, Topic, Unit, VideoStore, YouTubeResource
+
+
+def sleeping_download(seconds, ratelimit=None):
+    time.sleep(seconds)
+    return 1
+
+
+def run_sleeping_downloads(workers, jobs=8, seconds=.1):
+    start = time.time()
+    with DownloadScheduler(workers=workers) as scheduler:
+        futures = [scheduler.submit(sleeping_download, seconds) for _ in range(jobs)]
+    assert all(future.result() == 1 for future in futures)
+    return time.time() - start
+
+
+def test_workers_download_in_parallel():
+    serial = run_sleeping_downloads(1)
+    parallel = run_sleeping_downloads(4)
+
+    #near-linear: 4 workers take little more than a quarter of the serial time
+    assert serial >= .8
+    assert parallel < serial / 3
+
+
+def test_failed_download_does_not_stall_the_others():
+    def failing_download(ratelimit=None):
+        raise IOError("connection reset")
+
+    with DownloadScheduler(workers=2) as scheduler:
+        failed = scheduler.submit(failing_download)
+        futures = [scheduler.submit(sleeping_download, .01) for _ in range(4)]
+
+    with pytest.raises(IOError):
+        failed.result()
+    assert [future.result() for future in futures] == [1] * 4
+    assert scheduler.stats()["done"] == 5
+
+
+def test_unit_keeps_the_order_of_its_urls(backend, tmp_path):
+    backend.latency = .01
+    unit = Unit("Unit 1", "Unit 1")
+    unit.urls = [url for _, url in YouTubeResource(PLAYLIST_URL).playlist_name_links()]
+
+    with DownloadScheduler(workers=4) as scheduler:
+        unit.submit(scheduler, base_path=str(tmp_path))
+        unit.collect()
+
+    assert [child["source_id"] for child in unit.to_node()["children"]] == unit.urls
+
+
+def test_each_video_is_extracted_once(backend, tmp_path):
+    #the playlist is in two topics, as the duplicated topics of the channel
+    units = [unit for _ in range(2) for unit in Topic.auto_generate_units(
+                PLAYLIST_URL, "playlists")]
+
+    with DownloadScheduler(workers=4) as scheduler:
+        for unit in units:
+            unit.submit(scheduler, base_path=str(tmp_path))
+        for unit in units:
+            unit.collect()
+    nodes = [unit.to_node() for unit in units]
+
+    video_ids = {key for name, key in backend.per_id if name == "downloads"}
+    assert len(video_ids) == backend.videos
+    for video_id in video_ids:
+        assert backend.per_id[("videos", video_id)] == 1
+        assert backend.per_id[("downloads", video_id)] == 1
+    #the subtitles are listed from the info of the download
+    assert all(len(video["files"]) == 4 for node in nodes for video in node.get("children", [node]))
+
+
+def write_video(directory, video_id, size=1024):
+    filepath = os.path.join(directory, "{}.mp4".format(video_id))
+    with open(filepath, "wb") as f:
+        f.write(b"\x00" * size)
+    return filepath
+
+
+def test_video_store_appends_and_compacts(tmp_path):
+    directory = str(tmp_path)
+    store = VideoStore(directory)
+    for i in range(3):
+        for video_id in ("a", "b"):
+            filepath = write_video(directory, video_id, 1024 + i)
+            store.add(video_id, filepath, dict(id=video_id, title=video_id))
+    with open(os.path.join(directory, VideoStore.MANIFEST)) as f:
+        assert len(f.readlines()) == 6
+    store.close()
+    assert store.manifest.closed
+
+    reloaded = VideoStore(directory)
+
+    assert reloaded.videos == store.videos
+    assert reloaded.check("a")["size"] == 1026
+    with open(os.path.join(directory, VideoStore.MANIFEST)) as f:
+        assert len(f.readlines()) == 2
+
+
+def test_video_store_add_time_is_linear(tmp_path):
+    directory = str(tmp_path)
+    store = VideoStore(directory)
+    filepath = write_video(directory, "video")
+    start = time.time()
+    for i in range(2000):
+        store.add("{:011d}".format(i), filepath, dict(id="{:011d}".format(i), title="video"))
+    assert time.time() - start < 5
+    assert len(VideoStore(directory).videos) == 2000
+
+
+def test_cached_video_fetches_its_missing_subtitles_from_a_new_extraction(backend, tmp_path,
+        monkeypatch):
+    url = YouTubeResource.video_url("sub00000001")
+    monkeypatch.setattr(sushichef, "SUBTITLES", sushichef.SubtitleCache())
+    os.makedirs(str(tmp_path / "subtitles"))
+    sushichef.SUBTITLES.open(str(tmp_path / "subtitles"))
+    YouTubeResource(url).download(base_path=str(tmp_path))
+    store = VideoStore.get(str(tmp_path / "videos"))
+    subtitles = store.check("sub00000001")["info"]["subtitles"]
+    assert all("url" not in track for tracks in subtitles.values() for track in tracks)
+
+    #a later run without the tracks, the urls saved by the first one would have expired
+    monkeypatch.setattr(sushichef, "VIDEOS", sushichef.VideoRegistry())
+    monkeypatch.setattr(sushichef, "SUBTITLES", sushichef.SubtitleCache())
+    os.makedirs(str(tmp_path / "subtitles2"))
+    sushichef.SUBTITLES.open(str(tmp_path / "subtitles2"))
+    youtube = YouTubeResource(url)
+    youtube.download(base_path=str(tmp_path))
+
+    assert backend.per_id[("downloads", "sub00000001")] == 1
+    assert backend.per_id[("videos", "sub00000001")] == 2
+    assert all("path" in track for track in youtube.subtitles_dict())
+    assert len(youtube.subtitles_dict()) == 3
+
+
+def test_bandwidth_cap_is_shared_by_the_running_downloads():
+    running, peaks = [], []
+    lock = threading.Lock()
+
+    def download(seconds, ratelimit=None):
+        with lock:
+            running.append(ratelimit)
+            peaks.append(sum(running))
+        time.sleep(seconds)
+        with lock:
+            running.remove(ratelimit)
+
+    with DownloadScheduler(workers=4, bandwidth=400) as scheduler:
+        for i in range(12):
+            scheduler.submit(download, .01 * (i % 3 + 1), duration=i)
+
+    assert max(peaks) <= 400 * 1.001
+
+
+def test_bandwidth_of_the_downloads_that_can_run():
+    ratelimits = []
+
+    def download(ratelimit=None):
+        ratelimits.append(ratelimit)
+        time.sleep(.01)
+
+    #alone, at the end of the queue
+    with DownloadScheduler(workers=4, bandwidth=400) as scheduler:
+        scheduler.submit(download)
+    assert ratelimits == [400]
+
+    #the estimated size lets only two downloads run at a time
+    ratelimits = []
+    with DownloadScheduler(workers=4, bandwidth=400, max_bytes=2 * 62500 * 600) as scheduler:
+        for _ in range(6):
+            scheduler.submit(download)
+    assert ratelimits[:-1] == [200] * 5
+    #the last one may start alone
+    assert ratelimits[-1] in (200, 400)
+
+
+def test_failed_transcoding_keeps_the_downloaded_video(backend, tmp_path, monkeypatch):
+    transcoder = sushichef.Transcoder()
+    transcoder.path = str(tmp_path)
+    transcoder.profile = "low"
+    transcoder.executor = ThreadPoolExecutor(max_workers=2)
+
+    def ffmpeg(source, output):
+        raise OSError(28, "No space left on device")
+    monkeypatch.setattr(transcoder, "ffmpeg", ffmpeg)
+    unit = Unit("Unit 1", "Unit 1")
+    unit.urls = [url for _, url in YouTubeResource(PLAYLIST_URL).playlist_name_links()][:2]
+
+    with DownloadScheduler(workers=2) as scheduler:
+        unit.submit(scheduler, base_path=str(tmp_path))
+        unit.transcode(transcoder)
+        retries = unit.collect()
+
+    assert retries == []
+    paths = [video["files"][0]["path"] for video in unit.to_node()["children"]]
+    assert len(paths) == 2
+    assert all(path.startswith(str(tmp_path / "videos")) and os.path.exists(path)
+                for path in paths)
+
+
+def test_duplicate_video_is_queued_once(backend, tmp_path):
+    units = [unit for _ in range(3) for unit in Topic.auto_generate_units(
+                PLAYLIST_URL, "playlists")]
+
+    with DownloadScheduler(workers=2) as scheduler:
+        for unit in units:
+            unit.submit(scheduler, base_path=str(tmp_path))
+        for unit in units:
+            unit.collect()
+
+    #the duplicates never took a download worker
+    assert scheduler.stats()["done"] == backend.videos
+    assert sushichef.VIDEOS.stats()["downloads"] == dict(calls=backend.videos,
+                                                        collapsed=2 * backend.videos)
+    nodes = [unit.to_node() for unit in units]
+    assert nodes[:len(nodes) // 3] * 3 == nodes
+
+
+def test_retryable_download_is_queued_again(backend, tmp_path, monkeypatch):
+    monkeypatch.setattr(sushichef.RETRY_POLICY, "attempts", 1)
+    backend.failure_rate = 1.
+    url = YouTubeResource.video_url("ret00000001")
+    first, second = YouTubeResource(url), YouTubeResource(url)
+
+    with DownloadScheduler(workers=1) as scheduler:
+        sushichef.VIDEOS.submit(first, scheduler, True, str(tmp_path)).result()
+        assert first.retryable
+        backend.failure_rate = 0.
+        sushichef.VIDEOS.submit(second, scheduler, True, str(tmp_path)).result()
+
+    assert second.filepath is not None
+    assert sushichef.VIDEOS.stats()["downloads"] == dict(calls=2)
+
+
+def test_duplicate_video_is_transcoded_once(backend, tmp_path, monkeypatch):
+    transcoder = sushichef.Transcoder()
+    transcoder.path = str(tmp_path / "transcoded")
+    os.makedirs(transcoder.path)
+    transcoder.profile = "low"
+    transcoder.executor = ThreadPoolExecutor(max_workers=2)
+    sources = []
+
+    def ffmpeg(source, output):
+        sources.append(source)
+        with open(output, "wb") as f:
+            f.write(b"\x00" * 1024)
+        return True
+    monkeypatch.setattr(transcoder, "ffmpeg", ffmpeg)
+    urls = [url for _, url in YouTubeResource(PLAYLIST_URL).playlist_name_links()][:2]
+
+    #the duplicate is queued after the transcoding of the first unit is done
+    units = []
+    with DownloadScheduler(workers=2) as scheduler:
+        for _ in range(2):
+            unit = Unit("Unit 1", "Unit 1")
+            unit.urls = urls
+            unit.submit(scheduler, base_path=str(tmp_path))
+            unit.transcode(transcoder)
+            unit.collect()
+            units.append(unit)
+
+    assert sushichef.VIDEOS.stats()["transcodes"] == dict(calls=2, collapsed=2)
+    #only the downloaded files are compressed, never a compressed one
+    assert all(source.startswith(str(tmp_path / "videos")) for source in sources)
+    assert not os.path.exists(os.path.join(transcoder.path, VideoStore.MANIFEST))
+    assert units[0].to_node() == units[1].to_node()
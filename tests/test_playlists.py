@@ -0,0 +1,178 @@
+from collections import Counter
+import time
+
+import youtube_dl
+
+from conftest import PLAYLIST_URL
+import sushichef
+from sushichef import ChannelConfig, MetadataResolver, Topic, YouTubeResource
+
+
+def test_playlist_is_listed_with_one_flat_extraction(backend):
+    name_url = YouTubeResource(PLAYLIST_URL).playlist_name_links()
+
+    assert len(name_url) == backend.videos
+    assert all(title and url.startswith("https://www.youtube.com/watch?v=")
+                for title, url in name_url)
+    assert backend.calls == Counter(playlists=1)
+
+
+def test_video_without_title_is_extracted_alone(backend, monkeypatch):
+    entries = YouTubeResource(PLAYLIST_URL).playlist_entries()
+    entries[2]["title"] = None
+    monkeypatch.setattr(YouTubeResource, "playlist_entries", lambda self: entries)
+
+    name_url = YouTubeResource(PLAYLIST_URL).playlist_name_links()
+
+    assert len(name_url) == backend.videos
+    assert backend.calls == Counter(playlists=1, videos=1)
+
+
+def test_resolver_time_approaches_the_max_latency():
+    latency, urls = .2, ["https://host{}.test/playlist".format(i) for i in range(8)]
+
+    def extract(url):
+        time.sleep(latency)
+        return url
+
+    start = time.time()
+    results = MetadataResolver(concurrency=8).map(extract, urls)
+    seconds = time.time() - start
+
+    assert results == urls
+    assert seconds < 2 * latency
+
+
+def test_resolver_limits_the_rate_per_host():
+    urls = ["https://www.youtube.com/playlist?list={}".format(i) for i in range(5)]
+    other = ["https://other.test/{}".format(i) for i in range(5)]
+    starts = {}
+
+    def extract(url):
+        starts[url] = time.time()
+        return url
+
+    MetadataResolver(concurrency=8, rate=10).map(extract, urls + other)
+
+    assert max(starts[url] for url in urls) - min(starts[url] for url in urls) >= .35
+    assert max(starts[url] for url in other) - min(starts[url] for url in other) >= .35
+    #the hosts are throttled independently
+    assert max(starts.values()) - min(starts.values()) < .8
+
+
+def test_prefetch_lists_the_playlists_concurrently(backend):
+    backend.latency = .2
+    sources = [("https://www.youtube.com/playlist?list=PLfake{:04d}".format(i), "playlists")
+                for i in range(8)]
+
+    start = time.time()
+    sushichef.PLAYLISTS.prefetch(sources)
+    seconds = time.time() - start
+
+    assert backend.calls["playlists"] == 8
+    assert seconds < 2 * backend.latency
+    assert all(len(sushichef.PLAYLISTS.name_links(url, directory)) == backend.videos
+                for url, directory in sources)
+    assert backend.calls["playlists"] == 8
+
+
+def failing(func, failures, message="ERROR: HTTP Error 503: Service Unavailable"):
+    """`func` that raises a DownloadError on its first `failures` calls."""
+    calls = []
+
+    def wrapper(*args, **kwargs):
+        calls.append(args)
+        if len(calls) <= failures:
+            raise youtube_dl.utils.DownloadError(message)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def test_failed_listing_is_retried(backend, monkeypatch):
+    monkeypatch.setattr(backend, "playlist", failing(backend.playlist, 2))
+
+    name_url = sushichef.PLAYLISTS.name_links(PLAYLIST_URL, "playlists")
+
+    assert len(name_url) == backend.videos
+
+
+def test_empty_listing_is_not_kept(backend, monkeypatch):
+    monkeypatch.setattr(sushichef.RETRY_POLICY, "attempts", 2)
+    monkeypatch.setattr(backend, "playlist", failing(backend.playlist, 2))
+
+    assert sushichef.PLAYLISTS.name_links(PLAYLIST_URL, "playlists") == []
+    #the next unit with the playlist lists it again
+    assert len(sushichef.PLAYLISTS.name_links(PLAYLIST_URL, "playlists")) == backend.videos
+    assert len(sushichef.PLAYLISTS.name_links(PLAYLIST_URL, "playlists")) == backend.videos
+    assert backend.calls["playlists"] == 1
+
+
+def test_failed_relisting_keeps_the_previous_listing(backend, monkeypatch):
+    cache = sushichef.PLAYLISTS.cache
+    playlist_id = sushichef.PlaylistRegistry.playlist_id(PLAYLIST_URL)
+    previous = YouTubeResource(PLAYLIST_URL).playlist_name_links()
+    cache.write(playlist_id, "playlists", previous, {})
+    #--incremental=1 lists every playlist again
+    monkeypatch.setattr(cache, "ttl", 0)
+    monkeypatch.setattr(cache, "stale", 0)
+    monkeypatch.setattr(sushichef.RETRY_POLICY, "attempts", 1)
+    monkeypatch.setattr(backend, "playlist", failing(backend.playlist, 1))
+
+    name_url = sushichef.PLAYLISTS.name_links(PLAYLIST_URL, "playlists")
+    added, removed, unchanged = sushichef.PLAYLISTS.diff({playlist_id})
+
+    assert list(map(tuple, name_url)) == previous
+    assert added == removed == set()
+    assert unchanged == {url for _, url in previous}
+
+
+def test_background_refresh_is_not_the_incremental_baseline(backend, monkeypatch):
+    cache = sushichef.PLAYLISTS.cache
+    playlist_id = sushichef.PlaylistRegistry.playlist_id(PLAYLIST_URL)
+    listed = YouTubeResource(PLAYLIST_URL).playlist_name_links()
+    built = [("Old title", url) for _, url in listed[:3]]
+    cache.write(playlist_id, "playlists", built, {})
+    #stale: the tree is built from the saved listing, refreshed in the background
+    monkeypatch.setattr(cache, "ttl", 0)
+
+    assert list(map(tuple, sushichef.PLAYLISTS.name_links(PLAYLIST_URL, "playlists"))) == built
+    cache.close()
+    assert list(map(tuple, cache.read(playlist_id, "playlists")["videos"])) == built
+    assert list(map(tuple, cache.read(playlist_id, "playlists", pending=True)["videos"])) ==\
+        listed
+
+    #--incremental=1 compares with the listing the previous tree was built from
+    incremental = sushichef.PlaylistCache(ttl=0, stale=0)
+    incremental.promote = False
+    registry = sushichef.PlaylistRegistry(incremental)
+    registry.name_links(PLAYLIST_URL, "playlists")
+    added, removed, unchanged = registry.diff({playlist_id})
+
+    assert added == {url for _, url in listed} and unchanged == removed == set()
+    assert cache.read(playlist_id, "playlists", pending=True) is None
+
+
+def test_next_run_promotes_the_background_refresh(backend, monkeypatch):
+    cache = sushichef.PLAYLISTS.cache
+    playlist_id = sushichef.PlaylistRegistry.playlist_id(PLAYLIST_URL)
+    listed = YouTubeResource(PLAYLIST_URL).playlist_name_links()
+    cache.write(playlist_id, "playlists", listed[:3], {})
+    cache.write(playlist_id, "playlists", listed, {}, pending=True)
+
+    name_url = sushichef.PLAYLISTS.name_links(PLAYLIST_URL, "playlists")
+
+    assert list(map(tuple, name_url)) == listed
+    assert list(map(tuple, cache.read(playlist_id, "playlists")["videos"])) == listed
+    assert cache.read(playlist_id, "playlists", pending=True) is None
+    assert backend.calls["playlists"] == 1
+
+
+def test_topic_lists_its_playlists_with_the_registry_of_the_run(backend):
+    topic = Topic("Topic", "Topic")
+    topic.channel = ChannelConfig("channel", "Channel", "", "tree.json")
+    topic.sources = [dict(source_id=PLAYLIST_URL, title="Unit", lang="en")]
+
+    topic.load_units()
+
+    assert [len(unit.urls) for unit in topic.units] == [backend.videos]
+    assert sushichef.PLAYLISTS.misses == 1
@@ -0,0 +1,44 @@
+import youtube_dl
+
+from sushichef import CircuitBreaker, RetryPolicy
+
+
+def download_error(message):
+    return youtube_dl.utils.DownloadError(message)
+
+
+def test_classify():
+    policy = RetryPolicy(CircuitBreaker())
+
+    assert policy.classify(download_error(
+        "ERROR: [youtube] ab429cdEfgh: Video unavailable")) == RetryPolicy.PERMANENT
+    assert policy.classify(download_error(
+        "ERROR: unable to download video data: HTTP Error 429: Too Many Requests")) ==\
+        RetryPolicy.RATE_LIMITED
+    assert policy.classify(download_error(
+        "ERROR: [youtube] x4290000000: HTTP Error 503: Service Unavailable")) ==\
+        RetryPolicy.TRANSIENT
+    assert policy.classify(IOError("Connection reset by peer")) == RetryPolicy.TRANSIENT
+
+
+def test_no_backoff_after_the_last_attempt(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr("time.sleep", sleeps.append)
+    policy = RetryPolicy(CircuitBreaker(), attempts=3)
+
+    assert [policy.backoff(RetryPolicy.TRANSIENT, attempt) for attempt in range(3)] ==\
+        [True, True, False]
+    assert len(sleeps) == 2
+    assert policy.retries == 2
+
+
+def test_rate_limited_trips_the_breaker_without_sleeping(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr("time.sleep", sleeps.append)
+    breaker = CircuitBreaker(cooldown=60)
+    policy = RetryPolicy(breaker, attempts=2)
+
+    assert policy.backoff(RetryPolicy.RATE_LIMITED, 0) is True
+    assert policy.backoff(RetryPolicy.RATE_LIMITED, 1) is False
+    assert breaker.trips == 2
+    assert sleeps == []
@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from helpers import changed_title, old_parse_title, saved_titles
+import sushichef
+from sushichef import parse_title
+
+
+#the titles of the playlists listed by the last run of the chef in this checkout
+TITLES = saved_titles(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        sushichef.DATA_DIR))
+
+
+@pytest.mark.parametrize("title", [title for title in TITLES if not changed_title(title)])
+def test_same_as_the_old_chain(title):
+    assert parse_title(title) == old_parse_title(title)
+
+
+def test_range():
+    assert parse_title("مهارات في علم الرياضيات - الوحدة 3-1 - الأعداد الحقيقية")[:2] ==\
+        ("Unit 3", 3)
+    assert parse_title("Reading Comprehension 2-3")[:2] == ("Unit 2", 2)
+
+
+def test_unit_word():
+    assert parse_title("الوحدة 5 - المهارات اللغوية - الدرس الأول")[:2] == ("الوحدة 5", 5)
+    assert parse_title("الوحده 7 علم النفس التربوي")[:2] == ("الوحده 7", 7)
+    assert parse_title("الوحدة الأولى - مقدمة إلى التربية")[:2] == ("الوحدة", 1)
+
+
+def test_cleaned_title():
+    #the "| unit |" part, the math course name and the dashes are dropped
+    assert parse_title("English Level 1 | Unit 2 | Grammar - Present Simple")[2].split() ==\
+        ["English", "Level", "1", "|", "Grammar", "Present", "Simple"]
+    assert "مهارات في علم الرياضيات" not in\
+        parse_title("مهارات في علم الرياضيات - الوحدة 3-1 - الأعداد الحقيقية")[2]
+
+
+def test_pair_of_numbers():
+    #the old pattern02 branch raised NameError on these
+    assert parse_title("التجويد 3 1 أحكام النون الساكنة")[:2] == ("Unit 3", 3)
+    assert parse_title("Writing 10 11 Paragraphs")[:2] == ("Unit 10", 10)
+    with pytest.raises(NameError):
+        old_parse_title("التجويد 3 1 أحكام النون الساكنة")
+
+
+def test_arabic_indic_digits():
+    assert parse_title("القياس والتقويم - ٣")[:2] == ("القياس والتقويم", 3)
+    assert parse_title("القياس والتقويم - 3")[:2] == ("القياس والتقويم", 3)
+    assert parse_title("الإملاء العربي ٢-٤ همزة الوصل")[:2] == ("Unit ٢", 2)
+
+
+def test_saved_titles(tmp_path):
+    channel = tmp_path / "channel"
+    channel.mkdir()
+    (channel / "PL1.json").write_text('{"fetched_at": 0, "videos": [["a", "u1"], ["b", "u2"]]}')
+    (channel / "PL2.json").write_text('{"fetched_at": 0, "videos": [["b", "u2"], ["c", "u3"]]}')
+    (tmp_path / "trees").mkdir()
+    (tmp_path / "trees" / "report.json").write_text('{"videos": {"downloads": {}}}')
+
+    assert saved_titles(str(tmp_path)) == ["a", "b", "c"]
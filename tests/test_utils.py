@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+from helpers import range_server
+from utils import RangeDownloader, get_file_digests, read_json_lines
+
+
+def test_read_json_lines_skips_a_cut_last_line(tmp_path):
+    path = str(tmp_path / "index.jsonl")
+    with open(path, "w") as f:
+        f.write(json.dumps(dict(key="a", value=1)) + "\n")
+        f.write(json.dumps(dict(key="b", value=2)) + "\n")
+        f.write('{"key": "c", "val')
+
+    assert [record["key"] for record in read_json_lines(path)] == ["a", "b"]
+    with open(path, "a") as f:
+        f.write(json.dumps(dict(key="c", value=3)) + "\n")
+    assert [record["key"] for record in read_json_lines(path)] == ["a", "b", "c"]
+
+
+def test_read_json_lines_without_file(tmp_path):
+    assert list(read_json_lines(str(tmp_path / "missing.jsonl"))) == []
+
+
+@pytest.fixture
+def served(tmp_path):
+    """A random file of 8 MB on a local http server with byte ranges, and its md5."""
+    directory = tmp_path / "served"
+    directory.mkdir()
+    data = os.urandom(8 * 2**20)
+    (directory / "video.mp4").write_bytes(data)
+    server = range_server(str(directory))
+    yield server, "http://127.0.0.1:{}/video.mp4".format(server.server_port),\
+        hashlib.md5(data).hexdigest()
+    server.shutdown()
+
+
+def test_segmented_download_with_frequent_checkpoints(served, tmp_path):
+    _, url, checksum = served
+    destination = str(tmp_path / "video.mp4")
+    for _ in range(5):
+        downloader = RangeDownloader(segments=16, chunk_size=16384, min_segment_size=65536,
+                                    checkpoint=65536)
+        assert downloader.download(url, destination, checksum=checksum) == 8 * 2**20
+        assert get_file_digests(destination, ("md5",))["md5"] == checksum
+        assert not os.path.exists(destination + ".part.json")
+        os.remove(destination)
+
+
+def test_interrupted_download_is_resumed(served, tmp_path):
+    server, url, checksum = served
+    destination = str(tmp_path / "video.mp4")
+    server.budget = 4 * 2**20
+    with pytest.raises(Exception):
+        RangeDownloader(segments=4, retries=0, checkpoint=2**18).download(
+            url, destination, checksum=checksum)
+    server.budget = None
+    with open(destination + ".part.json") as f:
+        kept = sum(offset - start for start, _, offset in json.load(f)["segments"])
+    assert kept > 0
+
+    sent = server.sent
+    assert RangeDownloader(segments=4).download(url, destination, checksum=checksum) ==\
+        8 * 2**20
+    assert server.sent - sent <= 8 * 2**20 - kept + 4
+    assert get_file_digests(destination, ("md5",))["md5"] == checksum
+
+
+def test_checksum_mismatch(served, tmp_path):
+    _, url, _ = served
+    destination = str(tmp_path / "video.mp4")
+    with pytest.raises(IOError):
+        RangeDownloader().download(url, destination, checksum="0" * 32)
+    assert not os.path.exists(destination)
+
+
+def test_download_is_resumed_by_its_key(served, tmp_path):
+    #the confirmation token of a drive download changes with the session
+    server, url, checksum = served
+    destination = str(tmp_path / "video.mp4")
+    server.budget = 4 * 2**20
+    with pytest.raises(Exception):
+        RangeDownloader(segments=4, retries=0, checkpoint=2**18).download(
+            url, destination, checksum=checksum, params={"confirm": "a"}, key="file-id")
+    server.budget = None
+    with open(destination + ".part.json") as f:
+        kept = sum(offset - start for start, _, offset in json.load(f)["segments"])
+
+    sent = server.sent
+    assert RangeDownloader(segments=4).download(url, destination, checksum=checksum,
+        params={"confirm": "b"}, key="file-id") == 8 * 2**20
+    assert server.sent - sent <= 8 * 2**20 - kept + 4
@@ -1,7 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
 from git import Repo
+import hashlib
+import json
+import mmap
 import ntpath
 import os
 from pathlib import Path
+import re
+import requests
+from requests.adapters import HTTPAdapter
+import threading
 
 
 def if_dir_exists(filepath):
@@ -60,10 +68,45 @@ def clone_repo(git_url, repo_dir):
 def build_path(levels):
     path = os.path.join(*levels)
     if not if_dir_exists(path):
-        os.makedirs(path)
+        os.makedirs(path, exist_ok=True)
     return path
 
 
+def get_file_digests(filepath, algorithms=("md5", "sha1")):
+    """
+    The hex digests of the file for each algorithm, read through a memory map:
+    no copy to python buffers and hashlib releases the GIL on it.
+    """
+    hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    with open(filepath, "rb") as f:
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for file_hash in hashes:
+                    file_hash.update(data)
+    return {algorithm: file_hash.hexdigest() for algorithm, file_hash in zip(algorithms, hashes)}
+
+
+def read_json_lines(filepath, object_hook=None):
+    """
+    Yields the records of a json lines file, none if there is no file. A last
+    line cut by an interruption is skipped, and ended once all the records are
+    read, so the next line appended to the file is whole.
+    """
+    if not if_file_exists(filepath):
+        return
+    line = "\n"
+    with open(filepath, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line, object_hook=object_hook)
+            except ValueError:
+                continue
+            yield record
+    if not line.endswith("\n"):
+        with open(filepath, "a") as f:
+            f.write("\n")
+
+
 def get_video_resolution_format(video, maxvres=720, ext="mp4"):
     formats = [(int(s.resolution.split("x")[1]), s.extension, s) for s in video.videostreams]
     formats = sorted(formats, key=lambda x: x[0])
@@ -77,31 +120,49 @@ def get_video_resolution_format(video, maxvres=720, ext="mp4"):
         return best
 
 
-def get_node_from_channel(source_id, channel_tree, exclude=None):
-    parent = channel_tree["children"]
-    while len(parent) > 0:
-        for children in parent:
-            if children is not None and children["source_id"] == source_id:
-                return children
-        nparent = []
-        for children in parent:
-            try:
-                if children is not None and children["title"] != exclude:
-                    nparent.extend(children["children"])
-            except KeyError:
-                pass
-        parent = nparent
-
-
-def get_level_map(tree, levels):
-    actual_node = levels[0]
-    r_levels = levels[1:]
-    for children in tree.get("children", []):
-        if children["source_id"] == actual_node:
-            if len(r_levels) >= 1:
-                return get_level_map(children, r_levels)
-            else:
-                return children
+class TreeIndex(object):
+    """
+    Index of a json tree: source_id -> nodes and path -> node, the path being
+    the tuple of source_ids from the root (excluded) to the node, built in one
+    pass over the tree.
+    """
+    def __init__(self, tree=None):
+        self.paths = {}
+        self.sources = {}
+        if tree is not None:
+            self.walk([(node, ()) for node in tree.get("children", [])])
+
+    def walk(self, nodes):
+        #level by level, the nodes with the same source_id are found in that order
+        while len(nodes) > 0:
+            nparent = []
+            for node, parent in nodes:
+                if node is None:
+                    continue
+                path = parent + (node["source_id"],)
+                if path not in self.paths:
+                    self.sources.setdefault(node["source_id"], []).append(path)
+                self.paths[path] = node
+                nparent.extend((child, path) for child in node.get("children", []))
+            nodes = nparent
+
+    def get(self, source_id, exclude=None, kind=None):
+        """
+        The shallowest node with `source_id` (the first indexed at the same depth),
+        the subtrees under the nodes titled `exclude` are skipped and, with `kind`,
+        the nodes of other kinds.
+        """
+        for path in sorted(self.sources.get(source_id, []), key=len):
+            node = self.paths[path]
+            if kind is not None and node.get("kind") != kind:
+                continue
+            if exclude is None or all(self.paths[path[:i]]["title"] != exclude
+                                    for i in range(1, len(path))):
+                return node
+
+    def get_path(self, levels):
+        """The node at the end of `levels`, the source_ids from the root."""
+        return self.paths.get(tuple(levels))
 
 
 def remove_iframes(content):
@@ -117,10 +178,192 @@ def get_confirm_token(response):
     return None
 
 
-def save_response_content(response, destination):
-    CHUNK_SIZE = 32768
+def save_response_content(response, destination, chunk_size=1048576):
+    #the file object buffers the writes, the file is flushed once when it's closed
     with open(destination, "wb") as f:
-        for chunk in response.iter_content(CHUNK_SIZE):
+        for chunk in response.iter_content(chunk_size):
             if chunk:
                 f.write(chunk)
+
+
+class RangeDownloader(object):
+    """
+    Downloads a file in `segments` byte ranges fetched in parallel over a pooled
+    session, into a preallocated <destination>.part. The offsets reached by the
+    segments are saved in <destination>.part.json every `checkpoint` bytes, an
+    interrupted download resumes from there. At the end the size and, if given,
+    the checksum are verified before the file is moved to `destination`. A
+    server that doesn't serve ranges gets a single streamed request.
+    """
+    CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+    def __init__(self, session=None, segments=4, chunk_size=1048576, min_segment_size=1048576,
+            checkpoint=8388608, retries=3, timeout=60):
+        self.segments = segments
+        self.chunk_size = chunk_size
+        self.min_segment_size = min_segment_size
+        self.checkpoint = checkpoint
+        self.retries = retries
+        self.timeout = timeout
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=segments)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+        self.lock = threading.Lock()
+
+    def download(self, url, destination, checksum=None, algorithm="md5", params=None, key=None):
+        """
+        Returns the size of the file, raises IOError if it can't be verified. The
+        state saved for `destination` is resumed if it's of the same `key` and
+        size. The key is the url by default, a url with parameters of the session
+        (e.g. a confirmation token) needs a stable key, as the file id.
+        """
+        part = "{}.part".format(destination)
+        url = requests.Request("GET", url, params=params).prepare().url
+        size = self.probe(url)
+        if size is None:
+            response = self.session.get(url, stream=True, timeout=self.timeout)
+            response.raise_for_status()
+            save_response_content(response, part, self.chunk_size)
+            size = os.path.getsize(part)
+        else:
+            state = self.resume(key if key is not None else url, part, size)
+            self.write_state(part, state)
+            pending = [segment for segment in state["segments"] if segment[2] < segment[1]]
+            if len(pending) > 0:
+                with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                    list(executor.map(
+                        lambda segment: self.fetch(url, part, state, segment), pending))
+            if os.path.getsize(part) != size or \
+                    any(segment[2] != segment[1] for segment in state["segments"]):
+                raise IOError("Incomplete download of {}".format(url))
+        if checksum is not None and get_file_digests(part, (algorithm,))[algorithm] != checksum:
+            self.remove(part)
+            raise IOError("Checksum mismatch for {}".format(url))
+        os.replace(part, destination)
+        self.remove("{}.json".format(part))
+        return size
+
+    def probe(self, url):
+        """The size of the file if the server serves ranges of it, else None."""
+        response = self.session.get(url, headers={"Range": "bytes=0-0"},
+                                    stream=True, timeout=self.timeout)
+        try:
+            response.raise_for_status()
+            match = RangeDownloader.CONTENT_RANGE_RE.match(
+                response.headers.get("Content-Range", ""))
+            if response.status_code == 206 and match is not None:
+                return int(match.group(3))
+        finally:
+            response.close()
+
+    def resume(self, key, part, size):
+        """
+        The saved segments [start, end, offset reached] if they are of the same
+        download, else new ones over a new preallocated part file.
+        """
+        try:
+            with open("{}.json".format(part), "r") as f:
+                state = json.load(f)
+            if state["key"] == key and state["size"] == size and os.path.getsize(part) == size:
+                return state
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        with open(part, "wb") as f:
+            if size > 0 and hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(f.fileno(), 0, size)
+            else:
+                f.truncate(size)
+        count = max(1, min(self.segments, size // self.min_segment_size))
+        bounds = [size * i // count for i in range(count + 1)]
+        return dict(key=key, size=size,
+                    segments=[[start, end, start] for start, end in zip(bounds, bounds[1:])])
+
+    def write_state(self, part, state):
+        #the segments share the temporary file, one of them writes it at a time
+        with self.lock:
+            tmp = "{}.json.tmp".format(part)
+            with open(tmp, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp, "{}.json".format(part))
+
+    def save_state(self, part, state):
+        """Saves the state for the segments, a failed write loses the checkpoint only."""
+        try:
+            self.write_state(part, state)
+        except OSError:
+            pass
+
+    def fetch(self, url, part, state, segment):
+        """Fetches the rest of `segment`, retried from the offset reached."""
+        for attempt in range(self.retries + 1):
+            try:
+                self.fetch_range(url, part, state, segment)
+                return
+            except (requests.RequestException, IOError):
+                if attempt == self.retries:
+                    raise
+            finally:
+                self.save_state(part, state)
+
+    def fetch_range(self, url, part, state, segment):
+        _, end, offset = segment
+        response = self.session.get(url, stream=True, timeout=self.timeout,
+                                    headers={"Range": "bytes={}-{}".format(offset, end - 1)})
+        try:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise IOError("Range not served for {}".format(url))
+            with open(part, "r+b") as f:
+                f.seek(offset)
+                saved = offset
+                for chunk in response.iter_content(self.chunk_size):
+                    chunk = chunk[:end - offset]
+                    f.write(chunk)
+                    offset += len(chunk)
+                    #the offset is saved once the data before it is written to the file
+                    if offset - saved >= self.checkpoint and offset < end:
+                        f.flush()
+                        with self.lock:
+                            segment[2] = saved = offset
+                        self.save_state(part, state)
+                    if offset == end:
+                        break
                 f.flush()
+                with self.lock:
+                    segment[2] = offset
+        finally:
+            response.close()
+        if offset < end:
+            raise IOError("Range of {} cut at {} of {}".format(url, offset, end))
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def download_file(url, destination, segments=4, checksum=None, algorithm="md5"):
+    return RangeDownloader(segments=segments).download(url, destination, checksum=checksum,
+                                                        algorithm=algorithm)
+
+
+def download_file_from_google_drive(file_id, destination, segments=4, checksum=None):
+    """
+    The large files ask to confirm the download, the confirmation is a cookie of
+    the session; the download is resumed by the file id.
+    """
+    url = "https://docs.google.com/uc?export=download"
+    downloader = RangeDownloader(segments=segments)
+    response = downloader.session.get(url, params={"id": file_id}, stream=True)
+    token = get_confirm_token(response)
+    response.close()
+    params = {"id": file_id}
+    if token is not None:
+        params["confirm"] = token
+    return downloader.download(url, destination, checksum=checksum, params=params,
+                                key=file_id)